@@ -3,17 +3,22 @@
 import os
 import re
 import sys
+import copy
 import json
-import shlex
+import time
+import zlib
+import types
 import locale
 import urllib
 import decimal
+import hashlib
 import datetime
 import operator
 import functools
+import collections
 import itertools
+import contextlib
 import traceback
-import subprocess
 import email.utils
 import pkg_resources
 import email.mime.text
@@ -33,15 +38,43 @@ import werkzeug.exceptions
 import werkzeug.contrib.wrappers
 import werkzeug.contrib.securecookie
 
-from . import db, errors
+from . import (autocomplete, cache, db, errors, httpclient, outbox, store,
+               tasks, trace)
 
 
 #################
 # Configuration #
 #################
 
+ACCOUNT_CACHE_SIZE = 4096
+ACCOUNT_CACHE_TTL = 10          # seconds; 0 disables
+BACKGROUND_WORKERS = 4
 COOKIE_DOMAIN = None
+DB_POOL_SIZE = 16
+DB_POOL_TIMEOUT = 0.5
+DB_REPLICAS = []
+DB_REPLICA_LAG = 5
+EVENT_CACHE_SIZE = 4096
+EVENT_INDEX = False
+EVENTS_MAX_AGE = 60
+FACEBOOK_GRAPH_URL = 'https://graph.facebook.com'
+FACEBOOK_PAGE_SIZE = 500
+FILE_ACCEL_PREFIX = '/uploads'  # front proxy location serving UPLOAD_DIR
+FILE_BUFFER_SIZE = 65536
+FILE_DELIVERY = 'direct'        # or x-accel-redirect, x-sendfile
+GZIP_LEVEL = 6
+GZIP_MIN_SIZE = 1024
+HTTP_POOL_SIZE = 8
+HTTP_TIMEOUT = 10
+HTTP_WORKERS = 8
+INGEST_CHECK_INTERVAL = 5
+JSON_INDENT = None              # compact unless requested
+OUTBOX_WORKERS = 1
 SENDMAIL = '/usr/sbin/sendmail -t -oi'
+SMTP_HOST = None
+STRIPE_API_BASE = 'https://api.stripe.com'
+TRACE_BUFFER_SIZE = 256
+UPLOAD_MAX_SIZE = 10 * 2**20    # bytes
 
 # Required - defaults unused
 API_HOST = None
@@ -52,11 +85,38 @@ WWW_HOST = None
 _configuration_schema = {
     'type': 'object',
     'properties': {
+        'ACCOUNT_CACHE_SIZE': {'type': 'integer', 'minimum': 1},
+        'ACCOUNT_CACHE_TTL': {'type': 'number', 'minimum': 0},
         'API_HOST': {'type': 'string', 'pattern': 'https?://.*[^/]'},
+        'BACKGROUND_WORKERS': {'type': 'integer', 'minimum': 1},
+        'DB_POOL_SIZE': {'type': 'integer', 'minimum': 1},
+        'DB_POOL_TIMEOUT': {'type': 'number', 'minimum': 0},
+        'DB_REPLICAS': {'type': 'array', 'items': {'type': 'string'}},
+        'DB_REPLICA_LAG': {'type': 'integer', 'minimum': 0},
+        'EVENT_CACHE_SIZE': {'type': 'integer', 'minimum': 1},
+        'EVENT_INDEX': {'type': 'boolean'},
+        'EVENTS_MAX_AGE': {'type': 'integer', 'minimum': 0},
+        'FACEBOOK_GRAPH_URL': {'type': 'string', 'pattern': 'https?://.*[^/]'},
+        'FACEBOOK_PAGE_SIZE': {'type': 'integer', 'minimum': 1},
+        'FILE_ACCEL_PREFIX': {'type': 'string', 'pattern': '^/(.*[^/])?$'},
+        'FILE_BUFFER_SIZE': {'type': 'integer', 'minimum': 1},
+        'FILE_DELIVERY': {'enum': ['direct', 'x-accel-redirect',
+                                   'x-sendfile']},
+        'GZIP_LEVEL': {'type': 'integer', 'minimum': 1, 'maximum': 9},
+        'GZIP_MIN_SIZE': {'type': 'integer', 'minimum': 0},
+        'HTTP_POOL_SIZE': {'type': 'integer', 'minimum': 1},
+        'HTTP_TIMEOUT': {'type': 'number', 'minimum': 0},
+        'HTTP_WORKERS': {'type': 'integer', 'minimum': 1},
+        'INGEST_CHECK_INTERVAL': {'type': 'number', 'minimum': 0},
+        'JSON_INDENT': {'type': ['integer', 'null'], 'minimum': 0},
+        'OUTBOX_WORKERS': {'type': 'integer', 'minimum': 1},
         'SECRET_KEY': {'type': 'string'},
         'SENDMAIL': {'type': 'string'},
         'SMTP_HOST': {'type': 'string'},
+        'STRIPE_API_BASE': {'type': 'string', 'pattern': 'https?://.*[^/]'},
         'STRIPE_SECRET_KEY': {'type': 'string', 'pattern': 'sk_.+'},
+        'TRACE_BUFFER_SIZE': {'type': 'integer', 'minimum': 1},
+        'UPLOAD_MAX_SIZE': {'type': 'integer', 'minimum': 1},
         'WWW_HOST': {'type': 'string', 'pattern': 'https?://.*[^/]'},
     },
     'required': ['SECRET_KEY', 'STRIPE_SECRET_KEY', 'WWW_HOST'],
@@ -77,6 +137,13 @@ locale.setlocale(locale.LC_ALL, 'en_US.UTF-8')
 _load_configuration(__name__, os.environ['APP_ENV'])
 
 stripe.api_key = STRIPE_SECRET_KEY
+stripe.api_base = STRIPE_API_BASE
+db.configure(POOL_SIZE=DB_POOL_SIZE, POOL_TIMEOUT=DB_POOL_TIMEOUT,
+             POOL_REPLICAS=DB_REPLICAS)
+httpclient.configure(HTTP_POOL_SIZE=HTTP_POOL_SIZE, HTTP_TIMEOUT=HTTP_TIMEOUT)
+outbox.configure(SMTP_HOST=SMTP_HOST, SENDMAIL=SENDMAIL,
+                 WORKERS=OUTBOX_WORKERS)
+trace.configure(TRACE_BUFFER_SIZE=TRACE_BUFFER_SIZE)
 
 # Additional constants
 CITIES = {
@@ -87,10 +154,21 @@ FROM_ADDR = 'Bazaar <noreply@bazaar.bbsvc.net>'
 SETUP_PAYMENT_URL = WWW_HOST + '/#account'
 UPLOAD_PDF_URL = WWW_HOST + '/#listings/{0}/{1}/fulfill'
 UPLOAD_DIR = pkg_resources.resource_filename(__name__, 'uploads')
-
-if not os.path.exists(UPLOAD_DIR):
-    sys.stderr.write("creating UPLOAD_DIR `{}'".format(UPLOAD_DIR))
-    os.mkdir(UPLOAD_DIR, 0700)
+# Events are listed until this long after they start, as by the views.
+EVENT_GRACE = datetime.timedelta(minutes=5)
+# Attempts at a friend sync aborted by a deadlock, e.g. with a
+# concurrent sync of one of the friends.
+FRIEND_SYNC_ATTEMPTS = 3
+# Set for DB_REPLICA_LAG seconds after a client writes, so that its
+# reads go to the primary until replicas have caught up.
+PRIMARY_COOKIE = 'primary'
+
+# Runs work which the response need not wait for, such as friend syncs.
+background = tasks.Executor(BACKGROUND_WORKERS, 'background')
+# Issues independent outbound requests of a single API request at once.
+outbound = tasks.Executor(HTTP_WORKERS, 'outbound')
+# Uploaded files, which are streamed into it as requests are parsed.
+uploads = store.Store(UPLOAD_DIR, UPLOAD_MAX_SIZE)
 
 #############
 # Utilities #
@@ -115,6 +193,20 @@ def NoContent():
     del response.headers['Content-Type']
     return response
 
+def NotModified():
+    response = werkzeug.Response(status=304)
+    del response.headers['Content-Type']
+    return response
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
 def by_constraint(**constraints):
     def handle_error_by_constraint(request, e):
         err = constraints.get(e.diag.constraint_name)
@@ -128,28 +220,61 @@ def by_constraint(**constraints):
 ##############
 
 class JSONEncoder(json.JSONEncoder):
+    '''Encodes models through their `__json__' method. Without an
+    `indent', output is compact and produced by the C encoder.'''
+
+    def __init__(self, indent=None):
+        super(JSONEncoder, self).__init__(
+            indent=indent,
+            separators=(',', ':') if indent is None else (',', ': '))
+
     def default(self, o):
         if hasattr(o, '__json__'):
-            return dict(o.__json__())
+            return o.__json__()
         elif isinstance(o, datetime.datetime):
             o = o.replace(microsecond=0)
             return (o if o.tzinfo is None
                     else o.astimezone(pytz.utc)).isoformat()
         return super(JSONEncoder, self).default(o)
 
+def json_indent(request):
+    '''Indentation of the JSON responses to `request'. Clients may ask
+    for readable output with an X-Pretty-Print header.'''
+    return 2 if 'X-Pretty-Print' in request.headers else JSON_INDENT
+
 class JSONResponse(werkzeug.Response):
-    def __init__(self, response, status=None, headers=None):
+    def __init__(self, response, status=None, headers=None, indent=None):
         super(JSONResponse, self).__init__(
-            json.dumps(response, cls=JSONEncoder, indent=2)+'\n',
+            JSONEncoder(indent).encode(response)+'\n',
+            status=status, headers=headers,
+            mimetype='application/json')
+
+class JSONStreamResponse(werkzeug.Response):
+    '''Encode an iterable as a JSON array while it is being consumed,
+    rather than buffering the whole document before responding.'''
+
+    def __init__(self, iterable, status=None, headers=None, indent=None):
+        super(JSONStreamResponse, self).__init__(
+            self.encode(iterable, JSONEncoder(indent)),
             status=status, headers=headers,
             mimetype='application/json')
 
+    @staticmethod
+    def encode(iterable, encoder):
+        separator = '['
+        for o in iterable:
+            yield separator + encoder.encode(o)
+            separator = ',\n' if encoder.indent is not None else ','
+        yield '[]\n' if separator == '[' else ']\n'
+
 def request_middleware(middleware):
+    name = middleware.__name__.lstrip('_')
     @functools.wraps(middleware)
     def decorator(func):
         @functools.wraps(func)
         def _request_middleware(request):
-            middleware(request)
+            with trace.span(name):
+                middleware(request)
             return func(request)
         return _request_middleware
     return decorator
@@ -165,17 +290,52 @@ def response_middleware(middleware):
         return _response_middleware
     return decorator
 
+def wrap_trace(func):
+    '''Trace each request under its method and handler. Middleware
+    times only itself, so what is left of the handler is the span
+    `view', or `transaction' for the part of it run by `with_db'. The
+    trace of a streamed response only finishes once the response has
+    been closed, whether or not its body was sent. The time a database
+    connection was held for the request is the measure `db.hold'.'''
+    @functools.wraps(func)
+    def _wrap_trace(request):
+        current = trace.begin('{0} {1}'.format(request.method, func.__name__))
+        def finish():
+            # connections of a streamed response are returned on close
+            if request.transactions:
+                current.measure('db.hold', request.db_hold_time)
+            trace.finish(current)
+        try:
+            response = func(request)
+        except:
+            finish()
+            raise
+        if isinstance(response, werkzeug.BaseResponse) and \
+                response.is_streamed:
+            response.response = trace.iterate(current, response.response)
+            response.call_on_close(finish)
+        else:
+            finish()
+        return response
+    return _wrap_trace
+
 def wrap_errors(func):
     @functools.wraps(func)
+    @trace.traced('wrap_errors')
     def _wrap_errors(request):
         try:
             return func(request)
         except errors.APIError, error:
             traceback.print_exc(file=request.errors)
             return error
+        except db.ParameterError, e:
+            traceback.print_exc(file=request.errors)
+            return errors.invalid_request(e)
         except werkzeug.exceptions.BadRequest, e:
             traceback.print_exc(file=request.errors)
             return errors.not_understood(e.description)
+        except store.TooLarge, e:
+            return errors.file_too_large(str(e))
         except:
             traceback.print_exc(file=request.errors)
             try:
@@ -191,11 +351,85 @@ def wrap_errors(func):
             return errors.unknown_error()
     return _wrap_errors
 
-@response_middleware
-def wrap_no_cache(response):
-    response.headers['Cache-Control'] = 'no-store'
-    response.headers['Expires']       = 'Thu, 01 Jan 1970 00:00:00 GMT'
-    response.headers['Pragma']        = 'no-cache'
+CachePolicy = collections.namedtuple('CachePolicy', 'max_age public etag')
+
+def cache_policy(max_age=0, public=False, etag=None):
+    '''Allow responses of the decorated handler to be cached, by shared
+    caches too if `public', for `max_age' seconds. Responses carry an
+    ETag computed by `etag(request)' before the handler runs, or from
+    the body otherwise, and matching conditional requests are answered
+    with 304 Not Modified. ETags are weak, as responses may be gzipped.
+    Must be applied outermost.'''
+    def decorator(func):
+        func.cache_policy = CachePolicy(max_age, public, etag)
+        return func
+    return decorator
+
+def gzip_response(request, response):
+    '''Compress a JSON `response' if the client accepts gzip and it is
+    large enough, or is streamed.'''
+    if response.status_code != 200 or response.mimetype != 'application/json':
+        return
+    response.vary.add('Accept-Encoding')
+    if 'gzip' not in request.accept_encodings:
+        return
+    if response.is_streamed:
+        response.response = gzip_chunks(response.response)
+    elif len(response.get_data()) >= GZIP_MIN_SIZE:
+        response.set_data(str.join('', gzip_chunks([response.get_data()])))
+    else:
+        return
+    response.headers['Content-Encoding'] = 'gzip'
+
+def wrap_cache_policy(func):
+    policy = getattr(func, 'cache_policy', None)
+    @functools.wraps(func)
+    @trace.traced('wrap_cache_policy')
+    def _wrap_cache_policy(request):
+        etag = policy.etag(request) \
+               if policy is not None and policy.etag is not None \
+               else None
+        if etag is not None and request.if_none_match.contains_weak(etag):
+            response = NotModified()
+        else:
+            response = func(request)
+            if policy is not None and etag is None and \
+               response.status_code == 200 and not response.is_streamed \
+               and not isinstance(response, FileResponse):
+                etag = werkzeug.http.generate_etag(response.get_data())
+                if request.if_none_match.contains_weak(etag):
+                    response = NotModified()
+
+        if policy is None:
+            response.headers['Cache-Control'] = 'no-store'
+            response.headers['Expires'] = 'Thu, 01 Jan 1970 00:00:00 GMT'
+            response.headers['Pragma'] = 'no-cache'
+        else:
+            response.headers['Cache-Control'] = '{0}, {1}'.format(
+                'public' if policy.public else 'private',
+                'max-age={}'.format(policy.max_age)
+                if policy.max_age else 'no-cache')
+            response.vary.add('Accept-Encoding')
+            if policy.public:
+                response.vary.add('X-Pretty-Print')
+            if etag is not None:
+                # werkzeug spells the weak prefix in lower case
+                response.headers['ETag'] = \
+                    'W/' + werkzeug.http.quote_etag(etag)
+        gzip_response(request, response)
+        return response
+    return _wrap_cache_policy
+
+def wrap_replica_lag(func):
+    @functools.wraps(func)
+    @trace.traced('wrap_replica_lag')
+    def _wrap_replica_lag(request):
+        response = func(request)
+        if DB_REPLICAS and DB_REPLICA_LAG and getattr(request, 'wrote', False):
+            response.set_cookie(PRIMARY_COOKIE, '1', max_age=DB_REPLICA_LAG,
+                                httponly=True, domain=COOKIE_DOMAIN)
+        return response
+    return _wrap_replica_lag
 
 @request_middleware
 def wrap_format_request(func):
@@ -203,11 +437,13 @@ def wrap_format_request(func):
 
 def wrap_format_response(func):
     @functools.wraps(func)
+    @trace.traced('wrap_format_response')
     def _wrap_format_response(request):
         result = func(request)
         if isinstance(result, werkzeug.BaseResponse):
             return result
-        return JSONResponse(result)
+        with trace.span('encode'):
+            return JSONResponse(result, indent=json_indent(request))
     return _wrap_format_response
 
 class SecureCookie(werkzeug.contrib.securecookie.SecureCookie):
@@ -231,6 +467,8 @@ def wrap_sql_errors(**kwargs):
         def _wrap_sql_errors(request):
             try:
                 return func(request)
+            except (db.PoolTimeout, db.ParameterError):
+                raise
             except psycopg2.Error, e:
                 traceback.print_exc(file=request.errors)
                 handler = error_handlers.get(e.pgcode)
@@ -242,30 +480,124 @@ def wrap_sql_errors(**kwargs):
 
 def with_db(func):
     @functools.wraps(func)
+    @trace.traced('with_db')
     def _with_db(request):
-        with db.connect():
-            return func(request)
+        readonly = request.method == 'GET'
+        replica = readonly and PRIMARY_COOKIE not in request.cookies
+        try:
+            with db.connect(readonly=readonly,
+                            replica=replica) as transaction:
+                request.transactions.append(transaction)
+                with trace.span('transaction'):
+                    response = func(request)
+                if isinstance(response, JSONStreamResponse):
+                    # rows are still being fetched as the response is sent
+                    response.call_on_close(db.detach())
+        except db.PoolTimeout:
+            raise errors.database_unavailable()
+        request.wrote = not readonly
+        return response
     return _with_db
 
-core_meta_schema = json.load(pkg_resources.resource_stream(
-    jsonschema.__name__, 'schemas/draft4.json'))
+@contextlib.contextmanager
+def transaction(request):
+    '''Like `with_db', but for a single step of a handler which must not
+    hold a connection throughout, e.g. while calling Stripe.'''
+    try:
+        with db.connect() as transaction:
+            request.transactions.append(transaction)
+            yield
+    except db.PoolTimeout:
+        raise errors.database_unavailable()
+    request.wrote = True
 
 def format_schema(schema):
     return '\n\nParameters:\n    {}\n'.format(
         json.dumps(schema, indent=4).replace('\n', '\n    ').rstrip())
 
+simple_types = {
+    'boolean': (bool,),
+    'integer': (int, long),
+    'null': (types.NoneType,),
+    'number': (int, long, float),
+    'string': (basestring,),
+}
+
+def compile_property_check(schema):
+    if not set(schema) <= {'type', 'pattern', 'minimum', 'minLength'}:
+        return None
+    names = schema.get('type', simple_types.keys())
+    names = [names] if isinstance(names, basestring) else names
+    if not set(names) <= set(simple_types):
+        return None
+    allowed = sum((simple_types[name] for name in names), ())
+    boolean = 'boolean' in names
+    pattern = re.compile(schema['pattern']) if 'pattern' in schema else None
+    minimum = schema.get('minimum')
+    min_length = schema.get('minLength')
+    def check(value):
+        if not isinstance(value, allowed) or \
+                isinstance(value, bool) and not boolean:
+            return False
+        if isinstance(value, basestring):
+            return (pattern is None or pattern.search(value) is not None) and \
+                (min_length is None or len(value) >= min_length)
+        return minimum is None or isinstance(value, bool) or \
+            value >= minimum
+    return check
+
+def compile_precheck(schema):
+    '''Compile a flat object `schema' whose properties only restrict
+    their type, `pattern', `minimum' and `minLength' into a function
+    telling whether an instance is valid, or return None if it has
+    other keywords. The function never accepts an instance that the
+    full validator would reject, so it can be tried first.'''
+    if schema.get('type') != 'object' or not set(schema) <= {
+            'type', 'properties', 'required', 'additionalProperties'}:
+        return None
+    checks = {}
+    for name, subschema in schema.get('properties', {}).iteritems():
+        checks[name] = compile_property_check(subschema)
+        if checks[name] is None:
+            return None
+    required = schema.get('required', ())
+    additional = schema.get('additionalProperties', True)
+    if not isinstance(additional, bool):
+        return None
+    def precheck(instance):
+        if not isinstance(instance, dict):
+            return False
+        for name in required:
+            if name not in instance:
+                return False
+        for name in instance:
+            if name in checks:
+                if not checks[name](instance[name]):
+                    return False
+            elif not additional:
+                return False
+        return True
+    return precheck
+
 def validate(schema):
-    jsonschema.validate(schema, core_meta_schema)
+    '''Validate the arguments of a request against `schema', which is
+    compiled once here. Simple schemas are checked by a precompiled
+    function first, and only fall back to the full validator, which
+    produces the error message, if that fails.'''
+    jsonschema.Draft4Validator.check_schema(schema)
+    validator = jsonschema.Draft4Validator(schema)
+    precheck = compile_precheck(schema) or (lambda instance: False)
     @request_middleware
     def _validate(request):
+        instance = request.args \
+            if request.method == 'GET' \
+            else request.form \
+            if request.mimetype == 'multipart/form-data' \
+            else request.json
+        if precheck(instance):
+            return
         try:
-            jsonschema.validate(
-                request.args
-                if request.method == 'GET'
-                else request.form
-                if request.content_type == 'multipart/form-data'
-                else request.json,
-                schema)
+            validator.validate(instance)
         except jsonschema.ValidationError, e:
             raise errors.invalid_request(e)
     return _validate
@@ -275,17 +607,22 @@ def account_required(fetch=False):
     def _account_required(request):
         if not request.account:
             raise errors.invalid_session()
-        request.account = Account.find_one(request.account.id) \
+        request.account = request.find_one(Account, request.account.id) \
             if fetch \
             else Account(id=request.account.id)
     return _account_required
 
+@request_middleware
+def staff_required(request):
+    if not request.account.is_staff:
+        raise errors.forbidden()
+
 @request_middleware
 def listing_required(request):
-    request.listing = Listing.find_one(
-        int(request.routing_vars['id']),
-        where='seller__id=%s',
-        params=[request.account.id])
+    pk = int(request.routing_vars['id'])
+    request.listing = request.find_one(Listing, pk)
+    if request.listing.seller.id != request.account.id:
+        raise errors.not_found(Listing.db_table, {'pk': pk})
 
 
 ############
@@ -294,10 +631,18 @@ def listing_required(request):
 
 def facebook_fetch(access_token, resource=None, **params):
     params['access_token'] = access_token
-    response = requests.get(
-        str.join('/', ['https://graph.facebook.com/me'] +
+    return facebook_get(
+        str.join('/', [FACEBOOK_GRAPH_URL, 'me'] +
                  ([] if resource is None else [resource])),
-        params=params)
+        params)
+
+def facebook_get(url, params=None):
+    try:
+        with trace.span('facebook'):
+            response = httpclient.get(url, params=params)
+    except requests.RequestException:
+        # the message includes the url, and so the access token
+        raise errors.facebook_unavailable()
     if response.status_code == 200:
         return response.json()
     if 400 <= response.status_code < 500:
@@ -310,11 +655,72 @@ def get_facebook_picture(access_token, size):
     if not picture['data']['is_silhouette']:
         return picture['data']['url']
 
+def facebook_friends(access_token):
+    '''Generate the facebook ids of the friends of the owner of
+    `access_token', following the pages of the friends edge.'''
+    page = facebook_fetch(access_token, 'friends',
+                          fields='id', limit=FACEBOOK_PAGE_SIZE)
+    while page['data']:
+        for friend in page['data']:
+            yield int(friend['id'])
+        if 'next' not in page.get('paging', {}):
+            break
+        page = facebook_get(page['paging']['next'])
+
+@request_middleware
+def facebook_profile_required(request):
+    '''Fetch the profile and picture of the owner of the access token
+    concurrently, before any database connection is checked out. The
+    picture is fetched on another thread, outside the request's trace,
+    so only the time spent waiting for it once the profile has arrived
+    is traced.'''
+    access_token = request.json['access_token']
+    picture = outbound.submit(get_facebook_picture, access_token, 'square')
+    request.facebook = facebook_fetch(access_token)
+    with trace.span('facebook_picture'):
+        request.facebook_picture = picture.result()
+
+def sync_friends(facebook_id, access_token):
+    '''Replace the friendships of `facebook_id' with its current
+    friends on facebook. All pages are fetched before connecting to
+    the database. A sync rolled back by the database is retried, and
+    each failure is reported with its account.'''
+    friends = set(facebook_friends(access_token))
+    friends.discard(facebook_id)
+    for attempt in xrange(1, FRIEND_SYNC_ATTEMPTS + 1):
+        try:
+            with db.connect():
+                Account.set_friends(facebook_id, friends)
+            return
+        except psycopg2.extensions.TransactionRollbackError, e:
+            sys.stderr.write('friend sync of {0} failed (attempt {1} of {2}): '
+                             '{3}\n'.format(facebook_id, attempt,
+                                            FRIEND_SYNC_ATTEMPTS, e))
+            if attempt == FRIEND_SYNC_ATTEMPTS:
+                raise
+            time.sleep(0.1 * 2 ** attempt)
+
 
 ##########
 # Models #
 ##########
 
+def load_schema():
+    '''Load the schema snapshot, or an empty one if it is missing or
+    unreadable, in which case models query the database instead.'''
+    try:
+        return json.load(pkg_resources.resource_stream(__name__,
+                                                       'schema.json'))
+    except (IOError, ValueError), e:
+        sys.stderr.write('warning: cannot load schema snapshot ({}); '
+                         'querying database\n'.format(e))
+        return {}
+
+# Columns of the relations backing each model, keyed by
+# `schema.table'. Regenerate with `make snapshot-schema' whenever
+# db/schema.sql or db/views.sql change.
+SCHEMA = load_schema()
+
 class ModelMeta(type):
     def __new__(cls, name, bases, cls_attrs):
         if name == 'Model':
@@ -324,11 +730,18 @@ class ModelMeta(type):
             'db_schema': 'public',
             'db_table': name.lower(),
             'rel_fields': {},
+            'extra_fields': (),
         }
         attrs.update(cls_attrs)
         if 'db_fields' not in attrs:
-            with db.connect():
-                cols = db.column_names('%(db_schema)s.%(db_table)s' % attrs)
+            relid = '%(db_schema)s.%(db_table)s' % attrs
+            cols = SCHEMA.get(relid)
+            if cols is None:
+                sys.stderr.write("warning: `{}' missing from schema snapshot; "
+                                 "querying database\n".format(relid))
+                with db.connect():
+                    cols = db.column_names(relid)
+            attrs['db_columns'] = tuple(cols)
             rel_columns = {'{0}__{1}'.format(field, rel.pk_field)
                            for field, rel in attrs['rel_fields'].iteritems()}
             attrs['db_fields'] = tuple(
@@ -341,28 +754,65 @@ class ModelMeta(type):
                 column
                 for column in attrs['db_fields']
                 if column != attrs['pk_field'])
+        attrs['__slots__'] = tuple(sorted(
+            set(attrs['db_fields']) |
+            set(attrs.get('db_columns', ())) |
+            set(attrs['extra_fields'])))
+        attrs['_mappers'] = {}
         return type.__new__(cls, name, bases, attrs)
 
 class Model(object):
     __metaclass__ = ModelMeta
+    __slots__ = ()
 
     def __init__(self, **kwargs):
         for field in self.db_fields:
             setattr(self, field, kwargs.get(field))
 
-    def adapt(self, row):
-        rel_rows = {}
-        for k, v in row.iteritems():
-            rel = k.split('__', 1)
-            if len(rel) == 2:
-                rel_rows.setdefault(rel[0], {})[rel[1]] = v
+    @classmethod
+    def row_mapper(cls, columns):
+        '''Return a function building instances from result rows whose
+        column names are `columns'. Mappers are compiled once per query
+        shape and cached on the model.'''
+        try:
+            return cls._mappers[columns]
+        except KeyError:
+            mapper = cls._mappers[columns] = cls._compile_mapper(
+                tuple(enumerate(columns)))
+            return mapper
 
-        row = dict(row)
-        for rel, model in self.rel_fields.iteritems():
-            row[rel] = model().adapt(rel_rows.get(rel, {}))
-        for field, value in row.iteritems():
-            setattr(self, field, value)
-        return self
+    @classmethod
+    def _compile_mapper(cls, columns):
+        slots = set(cls.__slots__)
+        fields = []
+        rel_columns = {rel: [] for rel in cls.rel_fields}
+        for i, column in columns:
+            rel = column.split('__', 1)
+            if len(rel) == 2 and rel[0] in rel_columns:
+                rel_columns[rel[0]].append((i, rel[1]))
+            if column in slots and column not in cls.rel_fields:
+                fields.append((column, i))
+        rels = [(rel, model._compile_mapper(rel_columns[rel]))
+                for rel, model in cls.rel_fields.iteritems()]
+        present = {column for _, column in columns}
+        missing = [field for field in cls.db_fields
+                   if field not in present and field not in cls.rel_fields]
+
+        def mapper(row, obj=None):
+            if obj is None:
+                obj = cls.__new__(cls)
+                for field in missing:
+                    setattr(obj, field, None)
+            for field, i in fields:
+                setattr(obj, field, row[i])
+            for rel, rel_mapper in rels:
+                setattr(obj, rel, rel_mapper(row))
+            return obj
+        return mapper
+
+    def adapter(self, columns):
+        '''Row factory which updates this instance in place.'''
+        return functools.partial(self.row_mapper(columns), obj=self)
 
     @classmethod
     def find_one(cls, pk=None, db_table=None, where=None, params=None,
@@ -372,9 +822,14 @@ class Model(object):
         except StopIteration:
             raise errors.not_found(cls.db_table, {'pk': pk})
 
+    @classmethod
+    def find_cached(cls, pk):
+        '''Like `find_one', but may answer from a cache of the model.'''
+        return cls.find_one(pk)
+
     @classmethod
     def find(cls, pk=None, db_table=None, where=None, params=None,
-             order_by=None, limit=None):
+             order_by=None, limit=None, named=False):
         if where is None != params is None:
             raise ValueError('must supply both where and params')
         params = [] if params is None else list(params)
@@ -391,8 +846,8 @@ class Model(object):
                 else ' LIMIT ' + str(int(limit))
         query = 'SELECT * FROM {0} WHERE {1}{2}{3}'.format(
             db_table, where, order_by, limit)
-        for row in db.execute(query, params):
-            yield cls().adapt(row)
+        return db.execute(query, params, named=named, prepared=True,
+                          row_factory=cls.row_mapper)
 
     def _get_pk(self):
         return getattr(self, self.__class__.pk_field)
@@ -428,13 +883,17 @@ class Model(object):
             query = 'UPDATE {0} SET {1} WHERE {2}=%s RETURNING *'.format(
                 cls.db_table, str.join(', ', updates), cls.pk_field)
             params = map(operator.itemgetter(1), fields) + [self.pk]
-        row = db.execute_one(query, params)
-        return self.adapt(row)
+        return db.execute_one(query, params, prepared=True,
+                              row_factory=self.adapter)
 
 
-def zip_fields(*fields):
+def zip_fields(*fields, **computed):
+    '''Compile a `__json__' method returning a dict of the `fields' of a
+    model, plus the `computed' fields, each a function of the model.'''
+    getters = [(field, operator.attrgetter(field)) for field in fields]
+    getters.extend(computed.iteritems())
     def __json__(self):
-        return zip(fields, operator.attrgetter(*fields)(self))
+        return {field: get(self) for field, get in getters}
     return __json__
 
 class Venue(Model):
@@ -448,6 +907,15 @@ def parse_query(query):
     words = filter(None, word_boundary.split(query))
     return unicode.join(u' & ', words) + u':*'
 
+def fetch_ingest_generation():
+    return db.execute_one(
+        'SELECT CASE WHEN is_called THEN last_value ELSE 0 END '
+        '  FROM ingest_generation', ())[0]
+
+# Bumped by the ingest pipeline once it has refreshed the search views.
+ingest_generation = cache.Generation(fetch_ingest_generation,
+                                     INGEST_CHECK_INTERVAL)
+
 class Event(Model):
     db_table = 'full_event_search'
     rel_fields = {'venue': Venue}
@@ -460,57 +928,166 @@ class Event(Model):
         return str.join(
             ' ', self.datetime_local.strftime('%a %b %e %l:%M %p').split())
 
+    # Results of `search', keyed by ingest generation and query
+    search_cache = cache.LRUCache(EVENT_CACHE_SIZE)
+
     @classmethod
     def search(cls, city, query, limit=None):
+        '''Search the upcoming events of `city'. Cached results are
+        filtered again for events which have since passed, and fetched
+        anew if too few are left to be sure of filling `limit'.'''
+        limit = limit or 20
+        generation = ingest_generation.current()
+        after = datetime.datetime.now(pytz.utc) - EVENT_GRACE
+        if event_index is not None:
+            event_index.refresh(generation)
+            events = event_index.search(
+                city, filter(None, word_boundary.split(query.lower())), limit,
+                after)
+            if events is not None:
+                return events
+        terms = parse_query(query)
+        key = (generation, city, terms.lower(), limit)
+        events = cls.search_cache.get(key)
+        if events is not None:
+            upcoming = [event for event in events if event.datetime_utc > after]
+            if len(upcoming) == len(events) or len(events) < limit:
+                return upcoming
         where = "city__id=%s AND to_tsquery('english', %s) @@ search__terms"
-        return cls.find(where=where, params=(city, parse_query(query)),
-                        limit=limit or 20)
+        events = list(cls.find(where=where, params=(city, terms), limit=limit))
+        cls.search_cache.set(key, events)
+        return events
+
+tsvector_lexeme = re.compile(r"'((?:[^']|'')*)'")
+
+def load_event_index():
+    '''Build a prefix index over upcoming events. Events are indexed
+    under the lexemes of their search terms as well as the words of
+    their title, performers and venue, since query words are not
+    stemmed.'''
+    entries = []
+    vocabulary = set()
+    with db.connect(readonly=True, replica=True):
+        for event in Event.find(where='TRUE', params=(), named=True):
+            terms = {lexeme.replace("''", "'") for lexeme in
+                     tsvector_lexeme.findall(event.search__terms)}
+            for text in event.title, event.performer_names, event.venue.name:
+                terms.update(filter(None, word_boundary.split(text.lower())))
+            vocabulary.update(terms)
+            event.search__terms = None
+            entries.append((event.city__id, event.datetime_utc, terms, event))
+        # words dropped from queries by the english configuration
+        stopwords = [row[0] for row in db.execute(
+            "SELECT w FROM unnest(%s::text[]) w "
+            " WHERE numnode(plainto_tsquery('english', w)) = 0",
+            (list(vocabulary),))]
+    return autocomplete.PrefixIndex(entries, stopwords)
+
+event_index = autocomplete.Engine(load_event_index) if EVENT_INDEX else None
 
 class Account(Model):
     db_table = 'full_accounts'
     save_fields = ('facebook_id', 'email', 'full_name', 'access_token',
                    'tz', 'profile', 'stripe_customer')
 
+    public_json = zip_fields('id', 'created_at', 'full_name', 'tz', 'profile')
+    full_json = zip_fields('id', 'created_at', 'full_name', 'tz', 'profile',
+                           'email', 'facebook_id',
+                           has_card=lambda account: True)
+
+    # Accounts of authenticated requests, by id. Entries are dropped as
+    # accounts are written here, so they are only stale for up to the
+    # TTL after writes made elsewhere, e.g. by other processes.
+    find_cache = cache.TTLCache(ACCOUNT_CACHE_SIZE, ACCOUNT_CACHE_TTL)
+
     def __json__(self, full=False):
-        yield 'id', self.id
-        yield 'created_at', self.created_at
-        yield 'full_name', self.full_name
-        yield 'tz', self.tz
-        yield 'profile', self.profile
-        if full:
-            yield 'email', self.email
-            yield 'facebook_id', self.facebook_id
-            yield 'has_card', True
+        return self.full_json() if full else self.public_json()
+
+    @classmethod
+    def find_cached(cls, pk):
+        account = cls.find_cache.get(pk)
+        if account is None:
+            account = cls.find_one(pk)
+            cls.find_cache.set(pk, copy.copy(account))
+            return account
+        return copy.copy(account)
+
+    @classmethod
+    def forget(cls, pk):
+        '''Drop the cached account `pk', now and again once the current
+        transaction commits, as it may be cached again meanwhile from
+        a snapshot which predates the write.'''
+        cls.find_cache.delete(pk)
+        db.on_commit(functools.partial(cls.find_cache.delete, pk))
+
+    def save(self, force_insert=False):
+        account = super(Account, self).save(force_insert)
+        Account.forget(self.pk)
+        return account
 
     @classmethod
     def login(self, facebook_id, email, name, access_token, tz, picture):
         pk = db.callproc_one(
             'replace_account',
             facebook_id, email, name, access_token, tz, picture)[0]
+        Account.forget(pk)
         return Account.find_one(pk)
 
+    @classmethod
+    def set_friends(cls, facebook_id, friends):
+        '''Make `friends' the friendships of `facebook_id', loading them
+        with COPY and applying only the difference to `friendship'. The
+        facebook ids of both the old and the new friendships are locked
+        up front, in order, rather than one friendship at a time by the
+        triggers, which could deadlock with another sync. The account
+        itself is locked only against other syncs of it, not against
+        the key checks of friendships referring to it.'''
+        db.execute('SELECT 1 FROM account WHERE facebook_id = %s '
+                   'FOR NO KEY UPDATE', (facebook_id,))
+        db.execute('CREATE TEMPORARY TABLE friend_sync '
+                   '(friend bigint PRIMARY KEY) ON COMMIT DROP', ())
+        db.copy_from('friend_sync', ((friend,) for friend in friends))
+        db.execute('''
+        SELECT lock_facebook_ids(%s::bigint || ARRAY(SELECT s.friend
+                                                       FROM friend_sync s
+                                                      UNION
+                                                     SELECT f.friend
+                                                       FROM friendship f
+                                                      WHERE f.facebook_id = %s))
+        ''', (facebook_id, facebook_id))
+        db.execute('''
+        DELETE FROM friendship f
+         WHERE f.facebook_id = %s
+           AND NOT EXISTS (SELECT 1
+                             FROM friend_sync s
+                            WHERE s.friend = f.friend)
+        ''', (facebook_id,))
+        db.execute('''
+        INSERT INTO friendship (facebook_id, friend)
+        SELECT %s, s.friend
+          FROM friend_sync s
+         WHERE NOT EXISTS (SELECT 1
+                             FROM friendship f
+                            WHERE f.facebook_id = %s
+                              AND f.friend = s.friend)
+        ''', (facebook_id, facebook_id))
+
 class Listing(Model):
     db_table = 'full_listings'
     rel_fields = {'event': Event, 'seller': Account}
+    extra_fields = ('degree',)
     save_fields = ('event', 'seller', 'price', 'message')
 
-    __json__ = zip_fields('id', 'created_at', 'event', 'seller',
-                          'price', 'message')
+    base_json = zip_fields('id', 'created_at', 'event', 'seller',
+                           'price', 'message')
 
     def __json__(self, viewer=None):
-        yield 'id', self.id
-        yield 'created_at', self.created_at
-        yield 'event', self.event
-        yield 'seller', self.seller
-        yield 'price', self.price
-        yield 'message', self.message
+        fields = self.base_json()
         if viewer is not None:
-            yield 'is_own', viewer.id == self.seller.id
-        if hasattr(self, 'first_degree') and hasattr(self, 'second_degree'):
-            yield 'connection', 1 \
-                if self.first_degree \
-                else 2 if self.second_degree \
-                else None
+            fields['is_own'] = viewer.id == self.seller.id
+        if hasattr(self, 'degree'):
+            fields['connection'] = self.degree
+        return fields
 
     @property
     def display_price(self):
@@ -519,36 +1096,62 @@ class Listing(Model):
     @classmethod
     def search(cls, city, facebook_id):
         sql = '''
-        SELECT *
-          FROM available_listings
-         WHERE city__id = %s
-           AND buyer = %s
+        SELECT l.*
+             , c.degree AS degree
+          FROM full_listings l
+          LEFT JOIN connection c
+            ON c.buyer = %s
+           AND c.seller = l.seller__facebook_id
+         WHERE l.city__id = %s
+           AND l.seller__facebook_id <> %s
+         ORDER BY c.degree ASC
+                , l.event__datetime_utc ASC
          LIMIT 20
         '''
-        rows = db.execute(sql, params=(city, facebook_id))
-        return [cls().adapt(row) for row in rows]
+        return db.execute(sql, params=(facebook_id, city, facebook_id),
+                          row_factory=cls.row_mapper)
 
     @classmethod
     def own(cls, city, account):
         return cls.find(where='city__id=%s AND seller__id=%s',
-                        params=(city, account))
+                        params=(city, account), named=True)
 
 class Card(Model):
     db_table = 'stripe_card'
     save_fields = ('id', 'customer', 'fingerprint', 'full_name',
                    'expiration', 'last4', 'brand')
 
-    def __json__(self):
-        yield 'full_name', self.full_name
-        yield 'expiration', self.expiration.strftime('%Y-%m')
-        yield 'last4', '%04d' % self.last4
-        yield 'brand', self.brand
+    __json__ = zip_fields(
+        'full_name', 'brand',
+        expiration=lambda card: card.expiration.strftime('%Y-%m'),
+        last4=lambda card: '%04d' % card.last4)
 
 class Checkout(Model):
     # rel_fields = {'buyer': Account, 'listing': Listing}
     save_fields = ('customer', 'listing', 'stripe_card')
     __json__ = zip_fields('id', 'listing')
 
+class CheckoutIntent(Model):
+    db_table = 'checkout_intent'
+    save_fields = ('account', 'listing', 'idempotency_key', 'state', 'claim')
+
+    @classmethod
+    def find_by_key(cls, account, idempotency_key):
+        return next(cls.find(where='account=%s AND idempotency_key=%s',
+                             params=(account, idempotency_key)), None)
+
+    def lock(self):
+        '''Reload this intent, locking it until the end of the
+        transaction.'''
+        return db.execute_one(
+            'SELECT * FROM checkout_intent WHERE id=%s FOR UPDATE',
+            (self.id,), row_factory=self.adapter)
+
+    def stripe_key(self, step):
+        '''Idempotency key of one of the Stripe requests made for this
+        intent, so that a retried checkout repeats none of them.'''
+        return 'checkout-{0}-{1}'.format(self.id, step)
+
 class Pdf(Model):
     pk_field = 'ticket'
 
@@ -564,19 +1167,14 @@ class Pdf(Model):
 ##########
 
 def send_email(recipient, subject, body):
+    '''Queue an email, which is only sent if the current transaction
+    commits.'''
     message = email.mime.text.MIMEText(body)
     message['From'] = FROM_ADDR
     message['To'] = email.utils.formataddr(recipient)
     message['Subject'] = subject
-    sendmail = subprocess.Popen(
-        shlex.split(SENDMAIL),
-        stdin=subprocess.PIPE)
-
-    try:
-        sendmail.communicate(message.as_string())
-        sendmail.stdin.close()
-    finally:
-        sendmail.wait()
+    outbox.enqueue(email.utils.parseaddr(FROM_ADDR)[1], recipient[1],
+                   message.as_string())
 
 def Email(subject, template):
     body = pkg_resources.resource_string(
@@ -612,9 +1210,54 @@ class Request(werkzeug.Request,
               werkzeug.contrib.wrappers.JSONRequestMixin):
     errors = werkzeug.utils.environ_property('wsgi.errors')
 
+    @werkzeug.utils.cached_property
+    def transactions(self):
+        '''The database transactions of this request.'''
+        return []
+
+    @property
+    def db_hold_time(self):
+        '''Seconds a database connection was checked out for this
+        request, so far.'''
+        return sum(transaction.hold_time for transaction in self.transactions)
+
+    @werkzeug.utils.cached_property
+    def identity_map(self):
+        '''Model instances loaded by this request, by model and key.'''
+        return {}
+
+    def find_one(self, model, pk, cached=True):
+        '''Load the `model' with `pk' once per request, through the cache
+        of the model if it has one and `cached' is set. An uncached load
+        replaces any instance loaded before, e.g. once a transaction
+        which depends on the current row has begun.'''
+        key = model, pk
+        if not cached:
+            self.identity_map[key] = model.find_one(pk)
+        elif key not in self.identity_map:
+            self.identity_map[key] = model.find_cached(pk)
+        return self.identity_map[key]
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return uploads.spool()
+
 def ping(request):
     return werkzeug.Response('ok\n')
 
+def ingest_etag(request):
+    '''ETag of event searches, which change when ingest runs and as
+    events pass. The latter is only reflected every EVENTS_MAX_AGE
+    seconds, as caches may serve results that old anyway; without a
+    max age the ETag is left to be computed from the body.'''
+    if not EVENTS_MAX_AGE:
+        return None
+    with db.connect(readonly=True, replica=True):
+        generation = ingest_generation.current()
+    return 'ingest-{0}-{1}-{2}'.format(
+        generation, int(time.time() // EVENTS_MAX_AGE), json_indent(request))
+
+@cache_policy(max_age=EVENTS_MAX_AGE, public=True, etag=ingest_etag)
 @validate({
     'type': 'object',
     'properties': {
@@ -634,11 +1277,13 @@ def search_events(request):
     return list(Event.search(int(request.args['city']),
                              request.args['q'], limit=limit))
 
+@cache_policy()
 @with_db
 @account_required(True)
 def view_account(request):
     return request.account.__json__(full=True)
 
+@cache_policy()
 @with_db
 @account_required(True)
 def view_card(request):
@@ -657,16 +1302,19 @@ def view_card(request):
     },
     'required': ['access_token', 'tz'],
     'additionalProperties': False})
+@facebook_profile_required
 @with_db
 def login(request):
     '''Login with facebook. Creates a session cookie.'''
 
-    fb = facebook_fetch(request.json['access_token'])
-    picture = get_facebook_picture(request.json['access_token'], 'square')
+    fb = request.facebook
     account = Account.login(fb['id'], fb['email'], fb['name'],
                             request.json['access_token'],
-                            request.json['tz'], picture)
-    response = JSONResponse(account)
+                            request.json['tz'], request.facebook_picture)
+    db.on_commit(functools.partial(
+        background.submit, sync_friends, account.facebook_id,
+        request.json['access_token'], log_errors=True))
+    response = JSONResponse(account, indent=json_indent(request))
     expires = datetime.datetime.utcnow() + datetime.timedelta(30)
     SecureCookie({'account': account.id}, secret_key=SECRET_KEY).save_cookie(
         response, httponly=True, expires=expires, force=True,
@@ -683,9 +1331,12 @@ def login(request):
 @with_db
 @account_required(True)
 def search_listings(request):
-    return [dict(listing.__json__(request.account))
-            for listing in Listing.search(int(request.args['city']),
-                                          request.account.facebook_id)]
+    listings = Listing.search(int(request.args['city']),
+                              request.account.facebook_id)
+    # at most 20 rows, all fetched already; no need to hold the connection
+    return JSONResponse(
+        [listing.__json__(request.account) for listing in listings],
+        indent=json_indent(request))
 
 @with_db
 @validate({
@@ -697,9 +1348,10 @@ def search_listings(request):
     'additionalProperties': False})
 @account_required()
 def view_my_listings(request):
-    return [dict(listing.__json__(request.account))
-            for listing in Listing.own(int(request.args['city']),
-                                       request.account.id)]
+    listings = Listing.own(int(request.args['city']), request.account.id)
+    return JSONStreamResponse(
+        (listing.__json__(request.account) for listing in listings),
+        indent=json_indent(request))
 
 @validate({
     'type': 'object',
@@ -724,13 +1376,14 @@ def create_listing(request):
                    price=request.json['price'],
                    message=request.json.get('message')).save()
 
+@cache_policy()
 @with_db
 @account_required()
 def view_listing(request):
     '''View an available listing for buyers and sellers.'''
 
-    listing = Listing.find_one(int(request.routing_vars['id']))
-    return dict(listing.__json__(request.account))
+    listing = request.find_one(Listing, int(request.routing_vars['id']))
+    return listing.__json__(request.account)
 
 @validate({
     'type': 'object',
@@ -764,7 +1417,7 @@ def update_listing(request):
     '''
     params = (request.listing.price, request.listing.message,
               request.listing.id, request.account.id, request.listing.id)
-    return request.listing.adapt(db.execute_one(sql, params))
+    return db.execute_one(sql, params, row_factory=request.listing.adapter)
 
 @with_db
 @listing_required
@@ -792,66 +1445,96 @@ def remove_listing(request):
     },
     'required': ['listing'],
     'additionalProperties': False})
-@with_db
-@account_required(True)
+@account_required()
 @wrap_sql_errors(unique_violation=by_constraint(
-    claim_listing_key=errors.listing_claimed))
+    claim_listing_key=errors.listing_claimed,
+    checkout_intent_account_idempotency_key_key=errors.checkout_in_progress))
 def create_checkout(request):
     '''Update the credit card information for a customer through Stripe.'''
 
-    request.errors.write('creating checkout account={0} listing={1} '
-                         'customer={2}\n'.format(
-                             request.account.id, request.json['listing'],
-                             request.account.stripe_customer))
-
-    if request.account.stripe_customer is None and \
-       request.json.get('card_token') is None:
-        raise errors.card_missing()
+    card_token = request.json.get('card_token')
+    idempotency_key = request.headers.get('Idempotency-Key') or \
+        hashlib.sha1('{0}:{1}:{2}'.format(
+            request.account.id, request.json['listing'],
+            card_token or '')).hexdigest()
+
+    with transaction(request):
+        request.account = request.find_one(Account, request.account.id,
+                                           cached=False)
+        request.errors.write('creating checkout account={0} listing={1} '
+                             'customer={2}\n'.format(
+                                 request.account.id, request.json['listing'],
+                                 request.account.stripe_customer))
+        if request.account.stripe_customer is None and card_token is None:
+            raise errors.card_missing()
+        intent = CheckoutIntent.find_by_key(request.account.id,
+                                            idempotency_key)
+        if intent is not None and intent.state == 'finalized':
+            return Checkout.find_one(intent.claim)
+        listing = request.find_one(Listing, request.json['listing'])
+        if intent is None:
+            intent = CheckoutIntent(account=request.account.id,
+                                    listing=listing.id,
+                                    idempotency_key=idempotency_key,
+                                    state='pending').save()
+        elif intent.listing != listing.id:
+            raise errors.bad_request('idempotency key used for another '
+                                     'listing')
 
     customer = None             # stripe customer
     stripe_card = None          # claim with default card
-    listing = Listing.find_one(request.json['listing'])
 
     # Create or update stripe customer
-    if request.account.stripe_customer is None:
-        customer = stripe.Customer.create(
-            description='account={0} email={1}'.format(
-                request.account.id, request.account.email),
-            card=request.json['card_token'])
-        request.account.stripe_customer = customer.id
-        request.errors.write('adding customer={0} to account={0}\n'.format(
-            request.account.stripe_customer, request.account.id))
-        request.account.save()
-    elif request.json.get('card_token') is not None:
-        customer = stripe.Customer.retrieve(request.account.stripe_customer)
-        customer.card = request.json['card_token']
-        customer.save()
-
-    if customer is not None:           # card updated; save it
-        assert request.json.get('card_token') is not None
-        stripe_card = customer.default_card # claim with this card
-        card = customer.cards.data[0]
-        assert stripe_card == card.id
-        request.errors.write('creating card {}\n'.format(
-            json.dumps(card.to_dict(), sort_keys=True,
-                       cls=stripe.StripeObjectEncoder)))
-        expiration = datetime.date(card.exp_year, card.exp_month, 1)
-        Card(id=card.id, customer=customer.id, fingerprint=card.fingerprint,
-             full_name=card.name, expiration=expiration, last4=card.last4,
-             brand=card.type).save(force_insert=True)
-
-    checkout = Checkout(customer=request.account.stripe_customer,
-                        stripe_card=stripe_card, listing=listing.id).save()
-    request.errors.write(
-        'sending claim received email to {}\n'.format(
-            email.utils.formataddr((listing.seller.full_name,
-                                    listing.seller.email))))
-    city_slug = CITIES[listing.city__id]
-    send_claim_received_email(
-        recipient=listing.seller, buyer=request.account,
-        event=listing.event,
-        upload_pdf_url=UPLOAD_PDF_URL.format(city_slug, listing.id),
-        setup_payment_url=SETUP_PAYMENT_URL)
+    with trace.span('stripe'):
+        if request.account.stripe_customer is None:
+            customer = stripe.Customer.create(
+                description='account={0} email={1}'.format(
+                    request.account.id, request.account.email),
+                card=card_token, idempotency_key=intent.stripe_key('customer'))
+        elif card_token is not None:
+            customer = stripe.Customer.retrieve(
+                request.account.stripe_customer)
+            customer.card = card_token
+            customer.save(idempotency_key=intent.stripe_key('card'))
+
+    with transaction(request):
+        if intent.lock().state == 'finalized':
+            return Checkout.find_one(intent.claim)
+
+        if request.account.stripe_customer is None:
+            request.account.stripe_customer = customer.id
+            request.errors.write('adding customer={0} to account={1}\n'.format(
+                request.account.stripe_customer, request.account.id))
+            request.account.save()
+
+        if customer is not None:           # card updated; save it
+            assert card_token is not None
+            stripe_card = customer.default_card # claim with this card
+            card = customer.cards.data[0]
+            assert stripe_card == card.id
+            request.errors.write('creating card {}\n'.format(
+                json.dumps(card.to_dict(), sort_keys=True,
+                           cls=stripe.StripeObjectEncoder)))
+            expiration = datetime.date(card.exp_year, card.exp_month, 1)
+            Card(id=card.id, customer=customer.id,
+                 fingerprint=card.fingerprint, full_name=card.name,
+                 expiration=expiration, last4=int(card.last4),
+                 brand=card.type).save(force_insert=True)
+
+        checkout = Checkout(customer=request.account.stripe_customer,
+                            stripe_card=stripe_card, listing=listing.id).save()
+        intent.state, intent.claim = 'finalized', checkout.id
+        intent.save()
+        request.errors.write(
+            'sending claim received email to {}\n'.format(
+                email.utils.formataddr((listing.seller.full_name,
+                                        listing.seller.email))))
+        city_slug = CITIES[listing.city__id]
+        send_claim_received_email(
+            listing.seller, buyer=request.account,
+            event=listing.event,
+            upload_pdf_url=UPLOAD_PDF_URL.format(city_slug, listing.id),
+            setup_payment_url=SETUP_PAYMENT_URL)
 
     return checkout
 
@@ -877,12 +1560,10 @@ def view_checkout(request):
 def create_ticket(request):
     sys.stderr.write('form: %s\n' % request.form)
     sys.stderr.write('files: %s\n' % request.files)
-    if request.content_type == 'multipart/form-data':
+    if request.mimetype == 'multipart/form-data':
         if 'ticket' not in request.files:
             raise errors.file_missing('ticket')
-        filename = werkzeug.secure_filename(request.files['ticket'])
-        path = os.path.join(UPLOAD_DIR, filename)
-        request.files['ticket'].save(path)
+        request.files['ticket'].stream.commit('.pdf')
     else:
         pass
 
@@ -890,18 +1571,97 @@ def create_ticket(request):
 def view_ticket(request):
     pass
 
-class FileResponse(werkzeug.BaseResponse):
-    def __init__(self, path):
-        werkzeug.BaseResponse.__init__(self, mimetype='application/pdf')
-        self.path = path
-        st = os.stat(path)
-        self.headers['Content-Length'] = str(st.st_size)
-        self.headers['Last-Modified'] = werkzeug.http.http_date(st.st_mtime)
+class FileResponse(werkzeug.Response):
+    '''Sends the file `filename' of `directory' as FILE_DELIVERY says:
+    by handing it to the front proxy with an X-Accel-Redirect to its
+    location under FILE_ACCEL_PREFIX or an X-Sendfile of its path, or
+    directly. Direct responses answer conditional and single range
+    requests, and send whole files with the server's wsgi.file_wrapper
+    so that it may use sendfile(2). Handles its own ETag, so it is
+    exempt from that of `cache_policy'.'''
+
+    def __init__(self, directory, filename, mimetype='application/pdf'):
+        werkzeug.Response.__init__(self, mimetype=mimetype)
+        self.directory = directory
+        self.filename = filename
 
     def __call__(self, environ, start_response):
-        start_response('200 OK', self.headers.to_wsgi_list())
-        return werkzeug.wsgi.wrap_file(environ, file(self.path))
+        path = os.path.join(self.directory, self.filename)
+        if FILE_DELIVERY == 'x-accel-redirect':
+            self.headers['X-Accel-Redirect'] = '{0}/{1}'.format(
+                FILE_ACCEL_PREFIX.rstrip('/'), urllib.quote(self.filename))
+        elif FILE_DELIVERY == 'x-sendfile':
+            self.headers['X-Sendfile'] = path
+        else:
+            self.send_directly(environ, path)
+        return werkzeug.Response.__call__(self, environ, start_response)
+
+    def send_directly(self, environ, path):
+        st = os.stat(path)
+        size = st.st_size
+        mtime = datetime.datetime.utcfromtimestamp(int(st.st_mtime))
+        etag = '{0:x}-{1:x}-{2:x}'.format(st.st_ino, int(st.st_mtime), size)
+        self.headers['ETag'] = werkzeug.http.quote_etag(etag)
+        self.headers['Last-Modified'] = werkzeug.http.http_date(mtime)
+        self.headers['Accept-Ranges'] = 'bytes'
+        # If-None-Match compares weakly, and overrides If-Modified-Since
+        if_none_match = werkzeug.http.parse_etags(
+            environ.get('HTTP_IF_NONE_MATCH'))
+        if if_none_match:
+            modified = not if_none_match.contains_weak(etag)
+        else:
+            modified = werkzeug.http.is_resource_modified(
+                environ, last_modified=mtime)
+        if not modified:
+            self.status_code = 304
+            return
+
+        start, stop = 0, size
+        requested = werkzeug.http.parse_range_header(
+            environ.get('HTTP_RANGE'))
+        if_range = werkzeug.http.parse_if_range_header(
+            environ.get('HTTP_IF_RANGE'))
+        if requested is not None and environ['REQUEST_METHOD'] == 'GET' and \
+           (if_range.etag is None or if_range.etag == etag) and \
+           (if_range.date is None or if_range.date == mtime):
+            bounds = requested.range_for_length(size)
+            if bounds is not None:
+                start, stop = bounds
+                self.status_code = 206
+                self.headers['Content-Range'] = \
+                    requested.make_content_range(size).to_header()
+            elif requested.units == 'bytes' and len(requested.ranges) == 1:
+                self.status_code = 416
+                self.headers['Content-Range'] = 'bytes */{}'.format(size)
+                return
+            # several ranges are not supported, so the whole file is sent
+        self.headers['Content-Length'] = str(stop - start)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return
+
+        f = open(path, 'rb')
+        if stop - start == size:
+            self.response = werkzeug.wsgi.wrap_file(environ, f,
+                                                    FILE_BUFFER_SIZE)
+        else:
+            self.response = file_range(f, start, stop)
+        # the server's file wrapper must reach it unchanged
+        self.direct_passthrough = True
+
+def file_range(f, start, stop):
+    '''Generate the bytes of `f' from offset `start' up to `stop'.'''
+    try:
+        f.seek(start)
+        while start < stop:
+            data = f.read(min(FILE_BUFFER_SIZE, stop - start))
+            if not data:
+                break
+            start += len(data)
+            yield data
+    finally:
+        f.close()
 
+@cache_policy()
 @validate({
     'type': 'object',
     'properties': {
@@ -915,15 +1675,30 @@ def view_pdf(request):
     if 'pdf' not in token:
         raise errors.bad_request('invalid token')
     pdf = Pdf.find_one(token['pdf'])
-    return FileResponse(os.path.join(UPLOAD_DIR, pdf.filename))
+    return FileResponse(UPLOAD_DIR, pdf.filename)
+
+@with_db
+@account_required(True)
+@staff_required
+def view_pool_stats(request):
+    return db.pool_stats()
+
+@with_db
+@account_required(True)
+@staff_required
+def view_traces(request):
+    return trace.snapshot()
 
 router = selector.Selector(wrap=reduce(compose, [
     Request.application,
+    wrap_trace,
     wrap_errors,
-    wrap_no_cache,
+    wrap_cache_policy,
     wrap_format_request,
+    wrap_replica_lag,
     wrap_format_response,
     wrap_session_auth,
+    trace.traced('view'),
 ]))
 router.add('/ping', GET=ping)
 router.add('/account', GET=view_account, PUT=login)
@@ -937,3 +1712,5 @@ router.add('/checkouts/{id:digits}', GET=view_checkout)
 router.add('/tickets', POST=create_ticket)
 router.add('/tickets/{id:digits}', GET=view_ticket)
 router.add('/pdfs', GET=view_pdf)
+router.add('/admin/pool', GET=view_pool_stats)
+router.add('/admin/traces', GET=view_traces)
@@ -0,0 +1,97 @@
+# autocomplete.py - in-memory prefix index over event search terms
+
+import array
+import bisect
+import threading
+import time
+import traceback
+
+
+class PrefixIndex(object):
+    '''Per-city index mapping search terms to the events containing them.
+
+    `entries' is an iterable of (city, datetime, terms, event) tuples in
+    ascending datetime order. Each city keeps its events in that order
+    along with a sorted array of terms, each pointing at the positions
+    of its events, so that a prefix matches a contiguous run of terms.
+    '''
+
+    def __init__(self, entries, stopwords=()):
+        self.stopwords = frozenset(stopwords)
+        cities = {}
+        for city, when, terms, event in entries:
+            events, times, postings = cities.setdefault(city, ([], [], {}))
+            position = len(events)
+            events.append(event)
+            times.append(when)
+            for term in terms:
+                postings.setdefault(term, array.array('i')).append(position)
+        self.cities = {}
+        for city, (events, times, postings) in cities.iteritems():
+            terms = sorted(postings)
+            self.cities[city] = (events, times, terms,
+                                 [postings[term] for term in terms])
+
+    def search(self, city, words, limit, after):
+        '''Return at most `limit' events in `city' later than `after'
+        having, for every one of `words', a term beginning with it.
+        Returns None for queries which cannot be answered from the index.
+        '''
+        words = [word for word in words if word not in self.stopwords]
+        if not words or city not in self.cities:
+            return None
+        events, times, terms, postings = self.cities[city]
+        matches = None
+        for word in words:
+            found = set()
+            i = bisect.bisect_left(terms, word)
+            while i < len(terms) and terms[i].startswith(word):
+                found.update(postings[i])
+                i += 1
+            matches = found if matches is None else matches & found
+            if not matches:
+                return []
+        start = bisect.bisect_right(times, after)
+        return [events[i] for i in sorted(matches) if i >= start][:limit]
+
+class Engine(object):
+    '''Serves searches from the `PrefixIndex' returned by `load'.
+
+    `refresh' rebuilds the index in a background thread whenever the
+    ingest generation changes, swapping it in once it is complete.
+    Searches made before the first index is built return None.
+    '''
+
+    retry_interval = 60
+
+    def __init__(self, load):
+        self.load = load
+        self.index = None
+        self.generation = None
+        self._failed_at = 0
+        self._loading = threading.Lock()
+
+    def refresh(self, generation):
+        if generation == self.generation or \
+           time.time() - self._failed_at < self.retry_interval or \
+           not self._loading.acquire(False):
+            return
+        thread = threading.Thread(target=self._reload, args=(generation,),
+                                  name='autocomplete-reload')
+        thread.daemon = True
+        thread.start()
+
+    def _reload(self, generation):
+        try:
+            self.index, self.generation = self.load(), generation
+        except Exception:
+            traceback.print_exc()
+            self._failed_at = time.time()
+        finally:
+            self._loading.release()
+
+    def search(self, city, words, limit, after):
+        index = self.index
+        if index is None:
+            return None
+        return index.search(city, words, limit, after)
@@ -0,0 +1,73 @@
+# cache.py - in-process caches for query results
+
+import time
+import threading
+import collections
+
+
+class LRUCache(object):
+    '''A thread-safe mapping holding at most `size' entries, evicting the
+    least recently used entry first.'''
+
+    def __init__(self, size=1024):
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class TTLCache(LRUCache):
+    '''An `LRUCache' whose entries expire `ttl' seconds after they are
+    set.'''
+
+    def __init__(self, size=1024, ttl=10):
+        super(TTLCache, self).__init__(size)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        entry = super(TTLCache, self).get(key)
+        if entry is None or entry[0] <= time.time():
+            return default
+        return entry[1]
+
+    def set(self, key, value):
+        super(TTLCache, self).set(key, (time.time() + self.ttl, value))
+
+class Generation(object):
+    '''A counter bumped whenever the data behind a cache changes, read
+    with `fetch' at most once every `interval' seconds.'''
+
+    def __init__(self, fetch, interval=5):
+        self.fetch = fetch
+        self.interval = interval
+        self.value = None
+        self._checked = 0
+
+    def current(self):
+        now = time.time()
+        if now - self._checked >= self.interval:
+            self.value = self.fetch()
+            self._checked = now
+        return self.value
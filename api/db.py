@@ -1,40 +1,327 @@
 # db.py - manage connecting to the database
 
 import os
+import re
+import time
+import hashlib
 import operator
+import itertools
 import threading
+import traceback
 import contextlib
 
 import psycopg2.pool
-import psycopg2.extras
 import psycopg2.extensions
 
+from . import trace, util
+
+
+# Pool settings; override with `configure()' before first use.
+POOL_SIZE = 16
+POOL_TIMEOUT = 0.5              # seconds to wait for a free connection
+POOL_CHECK_INTERVAL = 30        # seconds idle before revalidating
+POOL_REPLICAS = ()              # DSNs of read replicas
+
+# Number of rows fetched per round trip, both for client-side cursors
+# and for named (server-side) cursors.
+ITERSIZE = 256
+
+# Bytes sent per round trip by `copy_from()'.
+COPY_BUFFER_SIZE = 65536
+
+class Connection(psycopg2.extensions.connection):
+    '''A connection which remembers the statements prepared on it, and
+    the types of their parameters.'''
+
+    def __init__(self, *args, **kwargs):
+        super(Connection, self).__init__(*args, **kwargs)
+        self.prepared = {}
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    pass
+
+class ParameterError(psycopg2.DataError):
+    pass
+
+# Parameters of a prepared statement are cast to its parameter types by
+# assignment, which would round a float into an integer or turn a
+# number into text where a literal would not compare equal or would
+# fail. Values of these types are checked before they are sent instead.
+_parameter_types = {
+    'smallint': (int, long),
+    'integer': (int, long),
+    'bigint': (int, long),
+    'boolean': (bool,),
+    'text': (basestring,),
+    'character varying': (basestring,),
+}
+
+class Pool(object):
+    '''A bounded, thread-safe pool of connections to `dsn'.'''
+
+    def __init__(self, dsn, size, timeout, check_interval, **kwargs):
+        self.dsn = dsn
+        self.size = size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.kwargs = kwargs
+        self._idle = []         # (connection, time returned), LIFO
+        self._in_use = 0
+        self._checked_out = {}  # connection -> time checked out
+        self._cond = threading.Condition()
+        self._stats = {
+            'checkouts': 0,
+            'connects': 0,
+            'discarded': 0,
+            'timeouts': 0,
+            'wait_time': 0.0,
+            'max_wait_time': 0.0,
+            'hold_time': 0.0,
+            'max_hold_time': 0.0,
+        }
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats, size=self.size,
+                         in_use=self._in_use, idle=len(self._idle))
+        return stats
+
+    def getconn(self):
+        start = time.time()
+        with self._cond:
+            while not self._idle and self._in_use >= self.size:
+                remaining = start + self.timeout - time.time()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout('no connection available after '
+                                      '{:.3f}s'.format(self.timeout))
+                self._cond.wait(remaining)
+            self._in_use += 1
+            conn, returned_at = self._idle.pop() if self._idle \
+                                else (None, None)
+            waited = time.time() - start
+            self._stats['checkouts'] += 1
+            self._stats['wait_time'] += waited
+            self._stats['max_wait_time'] = max(
+                self._stats['max_wait_time'], waited)
+        try:
+            if conn is not None and not self._check(conn, returned_at):
+                conn = None
+            if conn is None:
+                conn = psycopg2.connect(self.dsn, **self.kwargs)
+                with self._cond:
+                    self._stats['connects'] += 1
+        except:
+            self._release()
+            raise
+        with self._cond:
+            self._checked_out[conn] = time.time()
+        return conn
+
+    def _check(self, conn, returned_at):
+        healthy = not conn.closed
+        if healthy and time.time() - returned_at > self.check_interval:
+            try:
+                conn.cursor().execute('SELECT 1')
+                conn.rollback()
+            except psycopg2.Error:
+                healthy = False
+        if not healthy:
+            conn.close()
+            with self._cond:
+                self._stats['discarded'] += 1
+        return healthy
+
+    def putconn(self, conn):
+        '''Return `conn' to the pool, returning how long it was checked
+        out for.'''
+        with self._cond:
+            held = time.time() - self._checked_out.pop(conn)
+            self._stats['hold_time'] += held
+            self._stats['max_hold_time'] = max(
+                self._stats['max_hold_time'], held)
+        if not conn.closed:
+            try:
+                if conn.get_transaction_status() != \
+                   psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                conn.autocommit = False
+            except psycopg2.Error:
+                conn.close()
+        self._release(None if conn.closed else conn)
+        return held
+
+    def _release(self, conn=None):
+        with self._cond:
+            self._in_use -= 1
+            if conn is not None:
+                self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
 
 os.environ.setdefault('PGDATABASE', 'bazaar')
-_pool = psycopg2.pool.ThreadedConnectionPool(
-    1, 16, '', cursor_factory=psycopg2.extras.DictCursor)
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
 
+_pools = util.ProcessLocal()
+_pool_lock = threading.Lock()
+_inherited = []
 _tls = threading.local()
+_cursor_names = itertools.count()
+_placeholder = re.compile(r'%([s%])')
+
+def configure(**settings):
+    '''Override the POOL_* settings before the pools are created.'''
+    util.configure(globals(), 'POOL_', settings)
+
+def _get_pools():
+    '''The pools of this process, created on first use.'''
+    pools = _pools.get()
+    if pools is None:
+        with _pool_lock:
+            pools = _pools.get()
+            if pools is None:
+                if _pools.value is not None:
+                    # closing them would end the parent's sessions too
+                    _inherited.append(_pools.value)
+                pools = [Pool(dsn, POOL_SIZE, POOL_TIMEOUT,
+                              POOL_CHECK_INTERVAL,
+                              connection_factory=Connection)
+                         for dsn in ('',) + tuple(POOL_REPLICAS)]
+                pools = (pools[0], pools[1:],
+                         itertools.cycle(pools[1:] or pools))
+                _pools.set(pools)
+    return pools
+
+def close_pools():
+    '''Close the idle connections of this process and forget its pools,
+    e.g. before forking workers which should not inherit them.'''
+    with _pool_lock:
+        pools = _pools.get()
+        if pools is not None:
+            _pools.set(None)
+    if pools is not None:
+        primary, replicas, _ = pools
+        for pool in [primary] + replicas:
+            pool.closeall()
+
+def get_pool(replica=False):
+    '''Return the primary pool, or the next replica pool in turn if
+    `replica' is set and replicas are configured.'''
+    primary, _, rotation = _get_pools()
+    return next(rotation) if replica else primary
+
+def pool_stats():
+    primary, replicas, _ = _get_pools()
+    return {
+        'primary': primary.stats(),
+        'replicas': [pool.stats() for pool in replicas],
+    }
+
+class Transaction(object):
+    '''The state of a `connect()' block. No connection is checked out
+    until the block first needs one.'''
+
+    def __init__(self, readonly, replica):
+        self.readonly = readonly
+        self.replica = replica
+        self.conn = None
+        self.pool = None
+        self.detached = False
+        self.hold_time = 0.0    # seconds a connection was checked out
+        self.on_commit = []
+
+    @trace.traced('db.checkout')
+    def checkout(self):
+        pool = get_pool(self.readonly and self.replica)
+        try:
+            conn = pool.getconn()
+        except (PoolTimeout, psycopg2.OperationalError):
+            if pool is get_pool():
+                raise
+            pool = get_pool()
+            conn = pool.getconn()
+        conn.autocommit = self.readonly
+        self.conn, self.pool = conn, pool
+        return conn
+
+    def release(self, commit):
+        '''Commit if `commit' is set and return the connection, if one
+        was checked out. Returns whether the transaction committed.'''
+        if self.conn is None:
+            return commit
+        try:
+            if commit:
+                with trace.span('db.commit'):
+                    self.conn.commit()
+        finally:
+            self.hold_time += self.pool.putconn(self.conn)
+            self.conn = None
+        return commit
 
 @contextlib.contextmanager
-def connect():
-    _tls.conn = _pool.getconn()
+def connect(readonly=False, replica=False):
+    '''Run the block in a transaction, committing if it exits normally.
+    A connection is checked out by the first statement of the block, and
+    a `readonly' block autocommits, and may be routed to a `replica'.'''
+    transaction = _tls.transaction = Transaction(readonly, replica)
+    committed = False
     try:
-        yield
-        _tls.conn.cursor().execute('COMMIT')
+        yield transaction
+        if not transaction.detached:
+            committed = transaction.release(True)
     finally:
-        _pool.putconn(_tls.conn)
-        del _tls.conn
+        if not transaction.detached:
+            transaction.release(False)
+        del _tls.transaction
+    if committed:
+        _run_callbacks(transaction.on_commit)
 
-def get_connection():
+def detach():
+    '''Keep the current transaction open past the end of the `connect()'
+    block. Returns a function which commits and returns the connection
+    to the pool; the caller becomes responsible for calling it, e.g.
+    once a streamed response has been fully consumed.
+    '''
+    transaction = _get_transaction()
+    transaction.detached = True
+    def release():
+        if transaction.release(True):
+            _run_callbacks(transaction.on_commit)
+    return release
+
+def on_commit(callback):
+    '''Call `callback' once the current transaction has committed and
+    its connection has been returned to the pool. Nothing is called if
+    the transaction is rolled back.'''
+    _get_transaction().on_commit.append(callback)
+
+def _run_callbacks(callbacks):
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception:
+            # the transaction has already been committed
+            traceback.print_exc()
+
+def _get_transaction():
     try:
-        return _tls.conn
+        return _tls.transaction
     except AttributeError:
         raise RuntimeError("connection not initialized "
                            "(use `with {}.connect()')".format(__name__))
 
+def get_connection():
+    '''Return the connection of the current transaction, checking one
+    out if it has none yet.'''
+    transaction = _get_transaction()
+    return transaction.conn or transaction.checkout()
+
 def column_names(relid):
     rows = execute(
     '''SELECT attname
@@ -44,26 +331,140 @@ def column_names(relid):
           AND NOT attisdropped
         ORDER BY attnum
     ''', params=(relid,))
-    return map(operator.itemgetter('attname'), rows)
+    return map(operator.itemgetter(0), rows)
 
-def enumerate_rows(cursor):
-    while True:
-        row = cursor.fetchone()
-        if row is None:
-            raise StopIteration
-        yield row
+def enumerate_rows(cursor, row_factory=None):
+    '''Iterate over the rows of `cursor'. If given, `row_factory' is
+    called once with the tuple of column names and must return a
+    function converting each row tuple.'''
+    with trace.span('db.fetch'):
+        rows = cursor.fetchmany(ITERSIZE)
+    # named cursors only have a description after the first fetch
+    make_row = row_factory(tuple(column[0] for column in cursor.description)) \
+               if rows and row_factory is not None \
+               else None
+    while rows:
+        for row in rows if make_row is None else map(make_row, rows):
+            yield row
+        with trace.span('db.fetch'):
+            rows = cursor.fetchmany(ITERSIZE)
 
-def execute(query, params):
-    cursor = get_connection().cursor()
-    cursor.execute(query, params)
-    return enumerate_rows(cursor)
+def cursor(named=False):
+    '''Create a cursor on the current connection. Named cursors are
+    declared on the server, so rows are only transferred as they are
+    fetched rather than all at once when the query is executed.
+    '''
+    conn = get_connection()
+    if not named:
+        return conn.cursor()
+    # named cursors can only be declared inside a transaction
+    if conn.autocommit:
+        conn.autocommit = False
+    cursor = conn.cursor('cursor_{}'.format(next(_cursor_names)))
+    cursor.itersize = ITERSIZE
+    return cursor
 
-def execute_one(query, params):
-    return next(execute(query, params))
+def numbered(query):
+    '''Convert the `%s' placeholders of `query' into `$n' parameters.'''
+    numbers = itertools.count(1)
+    return _placeholder.sub(
+        lambda m: '%' if m.group(1) == '%' else '${}'.format(next(numbers)),
+        query)
+
+def prepare(query):
+    '''Prepare `query' on the current connection unless it already has
+    been, returning the name of the prepared statement. Statements are
+    named after a digest of their text, so each distinct query shape is
+    parsed and planned once per pooled connection.
+    '''
+    conn = get_connection()
+    name = 'stmt_' + hashlib.sha1(query).hexdigest()[:16]
+    if name not in conn.prepared:
+        cur = conn.cursor()
+        cur.execute('PREPARE {0} AS {1}'.format(name, numbered(query)))
+        cur.execute('SELECT parameter_types::text[] '
+                    '  FROM pg_prepared_statements WHERE name = %s', (name,))
+        conn.prepared[name] = cur.fetchone()[0]
+    return name
+
+def check_parameters(name, params):
+    '''Raise `ParameterError' unless `params' have the Python types of
+    the parameters of the prepared statement `name'.'''
+    types = get_connection().prepared[name]
+    for i, (value, type) in enumerate(zip(params, types), 1):
+        expected = _parameter_types.get(type)
+        if value is None or expected is None:
+            continue
+        if not isinstance(value, expected) or \
+           isinstance(value, bool) and bool not in expected:
+            raise ParameterError('parameter ${0} of {1} must be {2}, not '
+                                 '{3!r}'.format(i, name, type, value))
+
+def execute(query, params, named=False, prepared=False, row_factory=None):
+    # a named cursor can only be declared over a plain query
+    if prepared and not named:
+        name = prepare(query)
+        check_parameters(name, params)
+        query = 'EXECUTE {0}{1}'.format(
+            name, '({})'.format(str.join(', ', ['%s'] * len(params)))
+            if params else '')
+    cur = cursor(named)
+    with trace.span('db.execute'):
+        cur.execute(query, params)
+    return enumerate_rows(cur, row_factory)
+
+def execute_one(query, params, **kwargs):
+    return next(execute(query, params, **kwargs))
+
+class RowStream(object):
+    '''A file-like object reading `rows', an iterable of tuples, in the
+    text format of COPY, generating them only as they are read.'''
+
+    def __init__(self, rows):
+        self._lines = itertools.imap(self.format_row, rows)
+        self._buffer = ''
+
+    @staticmethod
+    def format_value(value):
+        if value is None:
+            return '\\N'
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        elif not isinstance(value, str):
+            value = str(value)
+        return value.replace('\\', '\\\\').replace('\t', '\\t') \
+                    .replace('\n', '\\n').replace('\r', '\\r')
+
+    @classmethod
+    def format_row(cls, row):
+        return str.join('\t', map(cls.format_value, row)) + '\n'
+
+    def read(self, size=-1):
+        chunks, length = [self._buffer], len(self._buffer)
+        while size < 0 or length < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = str.join('', chunks)
+        if size < 0:
+            size = len(data)
+        self._buffer = data[size:]
+        return data[:size]
+
+def copy_from(table, rows, columns=None):
+    '''Load `rows', an iterable of tuples, into `table' with a single
+    COPY. Rows are streamed to the server as they are generated.'''
+    cursor = get_connection().cursor()
+    with trace.span('db.copy'):
+        cursor.copy_from(RowStream(rows), table, size=COPY_BUFFER_SIZE,
+                         columns=columns)
 
 def callproc(procname, *args):
     cursor = get_connection().cursor()
-    cursor.callproc(procname, args)
+    with trace.span('db.callproc'):
+        cursor.callproc(procname, args)
     return enumerate_rows(cursor)
 
 def callproc_one(procname, *args):
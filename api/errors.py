@@ -33,6 +33,10 @@ class invalid_request(APIError):
     message = 'invalid request body'
 
     def __init__(self, error):
+        if not hasattr(error, 'validator'):
+            # not a schema violation, e.g. a parameter of the wrong type
+            super(invalid_request, self).__init__(context=str(error))
+            return
         super(invalid_request, self).__init__(
             context=error.message,
             params={
@@ -65,6 +69,11 @@ class file_missing(APIError):
     error   = 1060
     message = 'expected file upload'
 
+class file_too_large(APIError):
+    code    =  413
+    error   = 1070
+    message = 'uploaded file too large'
+
 class bad_request(APIError):
     code    =  400
     error   = 1099
@@ -84,11 +93,21 @@ class facebook_misc(APIError):
     error   = 2010
     message = 'misc Facebook error'
 
+class facebook_unavailable(APIError):
+    code    =  503
+    error   = 2020
+    message = 'Facebook unavailable'
+
 class listing_claimed(APIError):
     code    =  403
     error   = 3000
     message = 'listing already claimed'
 
+class checkout_in_progress(APIError):
+    code    =  409
+    error   = 3010
+    message = 'checkout already in progress'
+
 class unknown_error(APIError):
     code    =  500
     error   = 9000
@@ -98,3 +117,8 @@ class database_error(APIError):
     code    =  500
     error   = 9010
     message = 'unknown database error'
+
+class database_unavailable(APIError):
+    code    =  503
+    error   = 9020
+    message = 'database connections exhausted'
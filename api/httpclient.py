@@ -0,0 +1,41 @@
+# httpclient.py - shared keep-alive sessions for outbound HTTP
+
+import urlparse
+import threading
+
+import requests
+import requests.adapters
+
+from . import util
+
+
+# Client settings; override with `configure()' before first use.
+HTTP_POOL_SIZE = 8              # connections kept alive per host
+HTTP_TIMEOUT = 10               # seconds to wait for the server
+
+_sessions = util.ProcessLocal()
+_lock = threading.Lock()
+
+def configure(**settings):
+    '''Override the HTTP_* settings before the sessions are created.'''
+    util.configure(globals(), 'HTTP_', settings)
+
+def session(url):
+    '''Return this process's keep-alive session for the host of `url'.'''
+    parts = urlparse.urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    with _lock:
+        sessions = _sessions.get()
+        if sessions is None:
+            sessions = {}
+            _sessions.set(sessions)
+        if key not in sessions:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            sessions[key] = requests.Session()
+            sessions[key].mount('{}://'.format(parts.scheme), adapter)
+        return sessions[key]
+
+def get(url, **kwargs):
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    return session(url).get(url, **kwargs)
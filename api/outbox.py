@@ -0,0 +1,161 @@
+# outbox.py - deliver email queued in the database
+
+import os
+import shlex
+import socket
+import smtplib
+import threading
+import traceback
+import subprocess
+
+from . import db, trace, util
+
+
+# Outbox settings; override with `configure()' before first use.
+SMTP_HOST = None                # deliver with sendmail if unset
+SMTP_TIMEOUT = 30
+SENDMAIL = '/usr/sbin/sendmail -t -oi'
+WORKERS = 1
+BATCH_SIZE = 50                 # messages claimed at a time
+LEASE = 300                     # seconds before a claimed message is retried
+POLL_INTERVAL = 30              # seconds between checks when idle
+RETRY_DELAY = 60                # seconds, doubled after each failed attempt
+MAX_ATTEMPTS = 8
+
+_wakeup = threading.Condition()
+_pending = False
+_pid = None
+
+def configure(**settings):
+    '''Override the settings above before the workers are started.'''
+    util.configure(globals(), '', settings)
+
+def enqueue(sender, recipient, message):
+    '''Queue `message' for delivery from the `sender' to the `recipient'
+    address as part of the current transaction, waking a worker once it
+    commits.'''
+    db.execute('INSERT INTO outbox (sender, recipient, message) '
+               'VALUES (%s, %s, %s)', (sender, recipient, message))
+    db.on_commit(wake)
+
+def start():
+    '''Start the workers of this process, unless it has them already.
+    Call once a process is ready to serve, after any fork, so that
+    messages queued before it started or waiting to be retried are
+    delivered without waiting for another to be queued.'''
+    global _pid
+    with _wakeup:
+        if _pid != os.getpid():
+            _pid = os.getpid()
+            for i in xrange(WORKERS):
+                thread = threading.Thread(target=_work,
+                                          name='outbox-{}'.format(i))
+                thread.daemon = True
+                thread.start()
+
+def wake():
+    '''Have a worker check the outbox now, starting the workers if this
+    process has none yet.'''
+    global _pending
+    start()
+    with _wakeup:
+        _pending = True
+        _wakeup.notify()
+
+def _work():
+    global _pending
+    transport = SMTPTransport(SMTP_HOST) if SMTP_HOST else SendmailTransport()
+    while True:
+        try:
+            while traced_batch(transport) == BATCH_SIZE:
+                pass
+        except Exception:
+            traceback.print_exc()
+        with _wakeup:
+            if not _pending:
+                _wakeup.wait(POLL_INTERVAL)
+            _pending = False
+
+def traced_batch(transport):
+    current = trace.begin('outbox deliver_batch')
+    try:
+        return deliver_batch(transport)
+    finally:
+        trace.finish(current)
+
+def deliver_batch(transport):
+    '''Deliver up to BATCH_SIZE due messages through `transport',
+    returning the number claimed. The database connection is only held
+    while claiming messages and recording the outcome, not while they
+    are being sent.'''
+    with db.connect():
+        batch = list(db.execute('''
+        UPDATE outbox
+           SET deliver_at = current_timestamp + %s * interval '1 second'
+             , attempts = attempts + 1
+         WHERE id IN (SELECT id
+                        FROM outbox
+                       WHERE delivered_at IS NULL
+                         AND deliver_at <= current_timestamp
+                         AND attempts < %s
+                       ORDER BY deliver_at
+                       LIMIT %s
+                         FOR UPDATE)
+           AND deliver_at <= current_timestamp
+     RETURNING id, sender, recipient, message, attempts
+        ''', (LEASE, MAX_ATTEMPTS, BATCH_SIZE)))
+
+    delivered, failed = [], []
+    for id, sender, recipient, message, attempts in batch:
+        try:
+            transport.send(sender, recipient, message)
+            delivered.append(id)
+        except Exception, e:
+            traceback.print_exc()
+            failed.append((RETRY_DELAY * 2 ** (attempts - 1), repr(e), id))
+
+    if batch:
+        with db.connect():
+            db.execute('UPDATE outbox SET delivered_at = current_timestamp '
+                       ' WHERE id = ANY(%s)', (delivered,))
+            for params in failed:
+                db.execute('''
+                UPDATE outbox
+                   SET deliver_at = current_timestamp
+                                  + %s * interval '1 second'
+                     , last_error = %s
+                 WHERE id = %s
+                ''', params)
+    return len(batch)
+
+class SMTPTransport(object):
+    '''Sends messages over a connection to `host' which is kept open
+    across messages and batches, reconnecting once the server has
+    closed it.'''
+
+    def __init__(self, host):
+        self.host = host
+        self.smtp = None
+
+    @trace.traced('smtp')
+    def send(self, sender, recipient, message):
+        if self.smtp is not None:
+            try:
+                self.smtp.sendmail(sender, [recipient], message)
+                return
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                self.smtp = None
+        self.smtp = smtplib.SMTP(self.host, timeout=SMTP_TIMEOUT)
+        self.smtp.sendmail(sender, [recipient], message)
+
+class SendmailTransport(object):
+    '''Sends each message with a separate run of SENDMAIL.'''
+
+    @trace.traced('sendmail')
+    def send(self, sender, recipient, message):
+        sendmail = subprocess.Popen(shlex.split(SENDMAIL),
+                                    stdin=subprocess.PIPE)
+        sendmail.communicate(message)
+        if sendmail.returncode != 0:
+            raise RuntimeError('sendmail exited with status {}'.format(
+                sendmail.returncode))
@@ -0,0 +1,89 @@
+# store.py - keep uploaded files by the hash of their content
+
+import os
+import errno
+import hashlib
+import tempfile
+
+
+class TooLarge(Exception):
+    pass
+
+def makedirs(path):
+    try:
+        os.makedirs(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+class Store(object):
+    '''Files kept under `root' by the SHA-256 of their content, nested
+    `depth' directories deep in directories named by successive pairs
+    of its hex digits, so that no directory grows large and identical
+    files are only stored once. Uploads are spooled into `root'/tmp,
+    on the same file system, and linked into place once complete.'''
+
+    def __init__(self, root, max_size, depth=2):
+        self.root = root
+        self.max_size = max_size
+        self.depth = depth
+        self.spool_dir = os.path.join(root, 'tmp')
+        makedirs(self.spool_dir)
+
+    def spool(self):
+        '''A new `Upload' to write a file into.'''
+        return Upload(self)
+
+    def name(self, digest, suffix=''):
+        '''The path relative to `root' of the file with `digest'.'''
+        return os.path.join(*[digest[i:i + 2]
+                              for i in xrange(0, 2 * self.depth, 2)] +
+                             [digest + suffix])
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+class Upload(object):
+    '''A file being written into a `Store', hashed as it is written.
+    Raises `TooLarge' once more than the store's `max_size' bytes have
+    been written. The spooled file is removed when closed, so nothing
+    is left behind by uploads which are never committed.'''
+
+    def __init__(self, store):
+        self.store = store
+        self.file = tempfile.NamedTemporaryFile(prefix='upload-',
+                                                dir=store.spool_dir)
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.store.max_size:
+            self.close()
+            raise TooLarge('upload exceeds {} bytes'.format(
+                self.store.max_size))
+        self.hash.update(data)
+        self.file.write(data)
+
+    def commit(self, suffix=''):
+        '''Store the upload under its name followed by `suffix', unless
+        the same content is stored already, and return that name.'''
+        name = self.store.name(self.hash.hexdigest(), suffix)
+        path = self.store.path(name)
+        if not os.path.exists(path):
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            makedirs(os.path.dirname(path))
+            try:
+                os.link(self.file.name, path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.close()
+        return name
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,78 @@
+# tasks.py - run functions on background threads
+
+import os
+import sys
+import Queue
+import threading
+import traceback
+
+
+class Timeout(Exception):
+    pass
+
+class Future(object):
+    '''The eventual result of a function submitted to an `Executor'.'''
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        '''Wait up to `timeout' seconds for the function to finish and
+        return its result, re-raising its exception if it failed.'''
+        if not self._done.wait(timeout):
+            raise Timeout('task still running after {}s'.format(timeout))
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+class Executor(object):
+    '''Runs submitted functions on `workers' daemon threads of each
+    process, printing the errors of those submitted with `log_errors'.'''
+
+    def __init__(self, workers, name='task'):
+        self.workers = workers
+        self.name = name
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+
+    def submit(self, fn, *args, **kwargs):
+        log_errors = kwargs.pop('log_errors', False)
+        future = Future()
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+            self._queue.put((future, log_errors, fn, args, kwargs))
+        return future
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._queue = Queue.Queue()
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self._work, args=(self._queue,),
+                                      name='{}-{}'.format(self.name, i))
+            thread.daemon = True
+            thread.start()
+
+    def _work(self, queue):
+        while True:
+            future, log_errors, fn, args, kwargs = queue.get()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception:
+                if log_errors:
+                    traceback.print_exc()
+                future.set_exception(sys.exc_info())
@@ -0,0 +1,193 @@
+# trace.py - time the stages of requests
+
+import time
+import bisect
+import functools
+import threading
+import contextlib
+import collections
+
+from . import util
+
+
+# Trace settings; override with `configure()' before first use.
+TRACE_BUFFER_SIZE = 256         # finished traces kept for inspection
+TRACE_MAX_SPANS = 500           # spans kept per trace; the rest are counted
+TRACE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000) # ms
+
+_tls = threading.local()
+_lock = threading.Lock()
+_recent = collections.deque(maxlen=TRACE_BUFFER_SIZE)
+_histograms = {}
+_listeners = []
+
+def configure(**settings):
+    '''Override the TRACE_* settings, discarding the histograms.'''
+    global _recent
+    util.configure(globals(), 'TRACE_', settings)
+    with _lock:
+        _recent = collections.deque(_recent, maxlen=TRACE_BUFFER_SIZE)
+        _histograms.clear()
+
+class Trace(object):
+    '''The timed spans of one request, or other unit of work, called
+    `name'. Spans nest; each records its own duration and its self
+    time, which excludes that of the spans nested in it.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.started_at = time.time()
+        self.duration = None
+        self.spans = []         # (name, depth, offset, duration, self time)
+        self.totals = collections.defaultdict(float) # self time by name
+        self.calls = collections.defaultdict(int)    # spans by name
+        self.dropped = 0
+        self.measures = {}      # seconds measured apart from spans, by name
+        self._stack = []        # [name, start, time in nested spans]
+
+    def enter(self, name):
+        frame = [name, time.time(), 0.0]
+        self._stack.append(frame)
+        return frame
+
+    def exit(self):
+        name, start, nested = self._stack.pop()
+        duration = time.time() - start
+        if self._stack:
+            self._stack[-1][2] += duration
+        self.totals[name] += duration - nested
+        self.calls[name] += 1
+        if len(self.spans) < TRACE_MAX_SPANS:
+            self.spans.append((name, len(self._stack),
+                               start - self.started_at,
+                               duration, duration - nested))
+        else:
+            self.dropped += 1
+
+    def measure(self, name, seconds):
+        '''Add `seconds' to the measure `name', for time which is not
+        one span of this trace, such as that a resource was held.'''
+        self.measures[name] = self.measures.get(name, 0.0) + seconds
+
+    def __json__(self):
+        return {
+            'name': self.name,
+            'started_at': self.started_at,
+            'duration_ms': _ms(self.duration),
+            'dropped_spans': self.dropped,
+            'measures_ms': {name: _ms(seconds)
+                            for name, seconds in self.measures.iteritems()},
+            'spans': [{'name': name, 'depth': depth,
+                       'offset_ms': _ms(offset), 'duration_ms': _ms(duration),
+                       'self_ms': _ms(self_time)}
+                      for name, depth, offset, duration, self_time
+                      in sorted(self.spans, key=lambda span: span[2])],
+        }
+
+class Histogram(object):
+    '''Counts of durations falling into each of TRACE_BUCKETS.'''
+
+    def __init__(self):
+        self.counts = [0] * (len(TRACE_BUCKETS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(TRACE_BUCKETS, seconds * 1000)] += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def __json__(self):
+        count = sum(self.counts)
+        return {
+            'count': count,
+            'mean_ms': _ms(self.total / count) if count else None,
+            'max_ms': _ms(self.max),
+            'buckets': [{'le_ms': le, 'count': n} for le, n
+                        in zip(TRACE_BUCKETS + (None,), self.counts) if n],
+        }
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+def current():
+    '''The trace of the current thread, if it has begun one.'''
+    return getattr(_tls, 'trace', None)
+
+def begin(name):
+    '''Begin tracing the work of the current thread as `name'.'''
+    _tls.trace = Trace(name)
+    return _tls.trace
+
+def finish(trace):
+    '''Stop `trace', adding it to the recent traces and to the
+    histograms of its name: one of the total duration, one for each
+    span name of the self time spent in all spans of that name, and one
+    for each measure.'''
+    if current() is trace:
+        del _tls.trace
+    trace.duration = time.time() - trace.started_at
+    with _lock:
+        _recent.append(trace)
+        histograms = _histograms.setdefault(trace.name, {})
+        histograms.setdefault('total', Histogram()).add(trace.duration)
+        for name, seconds in trace.totals.iteritems():
+            histograms.setdefault(name, Histogram()).add(seconds)
+        for name, seconds in trace.measures.iteritems():
+            histograms.setdefault(name, Histogram()).add(seconds)
+    for listener in _listeners:
+        listener(trace)
+
+def subscribe(listener):
+    '''Call `listener' with each trace once it has finished, on the
+    thread which finished it.'''
+    _listeners.append(listener)
+
+@contextlib.contextmanager
+def span(name):
+    '''Time the block as a span of the current trace, if any.'''
+    trace = current()
+    if trace is None:
+        yield
+        return
+    trace.enter(name)
+    try:
+        yield
+    finally:
+        trace.exit()
+
+def traced(name):
+    '''Time each call of the decorated function as a span `name'.'''
+    def decorator(func):
+        @functools.wraps(func)
+        def _traced(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return _traced
+    return decorator
+
+def iterate(trace, iterable, name='stream'):
+    '''Generate the items of `iterable' as part of `trace'. Time spent
+    producing items is a span `name'; time spent by the consumer between
+    items is not counted. The caller finishes `trace', as the generator
+    may be closed without ever being started, e.g. for a HEAD request.'''
+    _tls.trace = trace
+    frame = trace.enter(name)
+    try:
+        for item in iterable:
+            paused = time.time()
+            yield item
+            frame[1] += time.time() - paused
+    finally:
+        trace.exit()
+
+def snapshot():
+    '''The histograms of each trace name, and the recent traces, oldest
+    first.'''
+    with _lock:
+        return {
+            'histograms': {name: {span: histogram.__json__()
+                                  for span, histogram in spans.iteritems()}
+                           for name, spans in _histograms.iteritems()},
+            'recent': list(_recent),
+        }
@@ -0,0 +1,28 @@
+# util.py - helpers shared by the modules of the API
+
+import os
+
+
+def configure(namespace, prefix, settings):
+    '''Override the upper case `settings' named with `prefix' in the
+    globals `namespace' of a module.'''
+    for name, value in settings.iteritems():
+        if not name.startswith(prefix) or not name.isupper() or \
+           name not in namespace:
+            raise TypeError('unknown setting {}'.format(name))
+        namespace[name] = value
+
+class ProcessLocal(object):
+    '''A value belonging to the process which set it. A forked process
+    starts over rather than share sockets with its parent.'''
+
+    def __init__(self):
+        self.pid = None
+        self.value = None
+
+    def get(self):
+        '''The value, or None if another process set it.'''
+        return self.value if self.pid == os.getpid() else None
+
+    def set(self, value):
+        self.pid, self.value = os.getpid(), value
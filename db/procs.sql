@@ -64,4 +64,254 @@ CREATE TRIGGER check_listing_modification_allowed
     FOR EACH ROW
     EXECUTE PROCEDURE listing_modification_allowed_trigger();
 
+-------------------------
+-- Connectedness Procs --
+-------------------------
+
+-- Friendship rows are only ever inserted and deleted. Each change
+-- adjusts the path counts in second_degree_friendship for the pairs
+-- passing through it, and recomputes the connection rows of those pairs
+-- and of the friendship itself.
+--
+-- The counts are read and then written, so changes are serialized on
+-- the facebook ids at both ends of each friendship: the two friendships
+-- making up a path share its middle id, so they never count it at the
+-- same time. The ids are advisory locks held until commit; a
+-- transaction changing many friendships should take all their ids at
+-- once, since they are locked in order to avoid deadlocks.
+CREATE OR REPLACE FUNCTION lock_facebook_ids(p_ids bigint[])
+RETURNS void
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock(i.id)
+       FROM (SELECT DISTINCT unnest(p_ids) AS id ORDER BY 1) i;
+END $$;
+
+-- Recompute the connection row for a single buyer and seller. Upserts
+-- rather than deleting and reinserting, so that two transactions
+-- refreshing the same pair at once cannot both insert it.
+CREATE OR REPLACE FUNCTION refresh_connection
+( p_buyer  bigint
+, p_seller bigint
+)
+RETURNS void
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_degree smallint;
+BEGIN
+    IF p_buyer <> p_seller
+       AND EXISTS (SELECT 1 FROM account a WHERE a.facebook_id = p_seller)
+    THEN
+        SELECT CASE
+               WHEN EXISTS (SELECT 1
+                              FROM friendship f
+                             WHERE f.facebook_id = p_buyer
+                               AND f.friend      = p_seller)
+               THEN 1
+               WHEN EXISTS (SELECT 1
+                              FROM second_degree_friendship s
+                             WHERE s.facebook_id = p_buyer
+                               AND s.friend      = p_seller)
+               THEN 2
+               END
+          INTO v_degree;
+    END IF;
+
+    IF v_degree IS NULL THEN
+        DELETE FROM connection
+         WHERE buyer  = p_buyer
+           AND seller = p_seller;
+    ELSE
+        INSERT INTO connection (buyer, seller, degree)
+             VALUES (p_buyer, p_seller, v_degree)
+        ON CONFLICT (buyer, seller)
+        DO UPDATE SET degree = EXCLUDED.degree
+                WHERE connection.degree <> EXCLUDED.degree;
+    END IF;
+END $$;
+
+-- Add p_paths (+1 or -1) to every second degree friendship passing
+-- through the friendship of p_facebook_id with p_friend, either as its
+-- first or its second hop. Another transaction may give a pair its
+-- first path at the same time through a different middle id, so new
+-- pairs are upserted.
+CREATE OR REPLACE FUNCTION adjust_second_degree_friendship
+( p_facebook_id bigint
+, p_friend      bigint
+, p_paths       integer
+)
+RETURNS void
+LANGUAGE plpgsql AS $$
+BEGIN
+    WITH delta AS (
+        SELECT p.facebook_id
+             , p.friend
+             , count(*) * p_paths AS paths
+          FROM (SELECT p_facebook_id AS facebook_id
+                     , f.friend      AS friend
+                  FROM friendship f
+                  JOIN account a
+                    ON f.friend = a.facebook_id
+                 WHERE f.facebook_id = p_friend
+                   AND f.friend     <> p_facebook_id
+                 UNION ALL
+                SELECT f.facebook_id
+                     , p_friend
+                  FROM friendship f
+                  JOIN account a
+                    ON a.facebook_id = p_friend
+                 WHERE f.friend       = p_facebook_id
+                   AND f.facebook_id <> p_friend) p
+         GROUP BY p.facebook_id, p.friend
+    ), updated AS (
+        UPDATE second_degree_friendship s
+           SET paths = s.paths + d.paths
+          FROM delta d
+         WHERE s.facebook_id = d.facebook_id
+           AND s.friend      = d.friend
+     RETURNING s.facebook_id, s.friend
+    )
+    INSERT INTO second_degree_friendship (facebook_id, friend, paths)
+    SELECT d.facebook_id, d.friend, d.paths
+      FROM delta d
+     WHERE d.paths > 0
+       AND NOT EXISTS (SELECT 1
+                         FROM updated u
+                        WHERE u.facebook_id = d.facebook_id
+                          AND u.friend      = d.friend)
+    ON CONFLICT (facebook_id, friend)
+    DO UPDATE SET paths = second_degree_friendship.paths + EXCLUDED.paths;
+
+    DELETE FROM second_degree_friendship
+     WHERE paths = 0
+       AND (facebook_id = p_facebook_id OR friend = p_friend);
+END $$;
+
+-- Runs before each row so that a statement changing several
+-- friendships counts every path exactly once: each row sees the rows
+-- of the same statement processed before it, but not those after.
+-- Inserts must therefore not be skipped after the trigger has run, so
+-- filter out existing friendships rather than ignoring conflicts.
+CREATE OR REPLACE FUNCTION second_degree_friendship_trigger()
+    RETURNS trigger
+    LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_row friendship;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        v_row := NEW;
+    ELSE
+        v_row := OLD;
+    END IF;
+
+    PERFORM lock_facebook_ids(ARRAY[v_row.facebook_id, v_row.friend]);
+    PERFORM adjust_second_degree_friendship(
+        v_row.facebook_id, v_row.friend,
+        CASE TG_OP WHEN 'INSERT' THEN 1 ELSE -1 END);
+
+    PERFORM refresh_connection(v_row.facebook_id, f.friend)
+       FROM friendship f
+      WHERE f.facebook_id = v_row.friend;
+    PERFORM refresh_connection(f.facebook_id, v_row.friend)
+       FROM friendship f
+      WHERE f.friend = v_row.facebook_id;
+
+    RETURN v_row;
+END $$;
+
+CREATE TRIGGER maintain_second_degree_friendship
+    BEFORE INSERT OR DELETE ON friendship
+    FOR EACH ROW
+    EXECUTE PROCEDURE second_degree_friendship_trigger();
+
+CREATE OR REPLACE FUNCTION friendship_connection_trigger()
+    RETURNS trigger
+    LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM refresh_connection(NEW.facebook_id, NEW.friend);
+    ELSE
+        PERFORM refresh_connection(OLD.facebook_id, OLD.friend);
+    END IF;
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER maintain_connection
+    AFTER INSERT OR DELETE ON friendship
+    FOR EACH ROW
+    EXECUTE PROCEDURE friendship_connection_trigger();
+
+-- Friends, and friends of friends, of a new account may already have
+-- listed it as a friend. Paths to it are counted once it is visible, so
+-- lock it with the middle ids of those paths; those listing it since
+-- they were read are locked again once it is held.
+CREATE OR REPLACE FUNCTION account_connection_trigger()
+    RETURNS trigger
+    LANGUAGE plpgsql
+AS $$
+BEGIN
+    FOR i IN 1 .. 2 LOOP
+        PERFORM lock_facebook_ids(NEW.facebook_id || ARRAY(
+            SELECT f.facebook_id
+              FROM friendship f
+             WHERE f.friend = NEW.facebook_id));
+    END LOOP;
+
+    INSERT INTO second_degree_friendship (facebook_id, friend, paths)
+    SELECT f1.facebook_id, NEW.facebook_id, count(*)
+      FROM friendship f1
+      JOIN friendship f2
+        ON f1.friend = f2.facebook_id
+     WHERE f2.friend       = NEW.facebook_id
+       AND f1.facebook_id <> NEW.facebook_id
+     GROUP BY f1.facebook_id;
+
+    PERFORM refresh_connection(p.facebook_id, NEW.facebook_id)
+       FROM (SELECT f.facebook_id
+               FROM friendship f
+              WHERE f.friend = NEW.facebook_id
+              UNION
+             SELECT s.facebook_id
+               FROM second_degree_friendship s
+              WHERE s.friend = NEW.facebook_id) p;
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER maintain_connection
+    AFTER INSERT ON account
+    FOR EACH ROW
+    EXECUTE PROCEDURE account_connection_trigger();
+
+-- Rebuild second_degree_friendship and connection from scratch, e.g.
+-- after bulk loading friendships with triggers disabled.
+CREATE OR REPLACE FUNCTION rebuild_connection()
+RETURNS void
+LANGUAGE sql AS $$
+    DELETE FROM connection;
+    DELETE FROM second_degree_friendship;
+
+    INSERT INTO second_degree_friendship (facebook_id, friend, paths)
+    SELECT f1.facebook_id, f2.friend, count(*)
+      FROM friendship f1
+      JOIN friendship f2
+        ON f1.friend = f2.facebook_id
+      JOIN account a
+        ON f2.friend = a.facebook_id
+     WHERE f1.facebook_id <> f2.friend
+     GROUP BY f1.facebook_id, f2.friend;
+
+    INSERT INTO connection (buyer, seller, degree)
+    SELECT p.buyer, p.seller, min(p.degree)
+      FROM (SELECT f.facebook_id AS buyer, f.friend AS seller, 1 AS degree
+              FROM friendship f
+              JOIN account a
+                ON f.friend = a.facebook_id
+             UNION ALL
+            SELECT s.facebook_id, s.friend, 2
+              FROM second_degree_friendship s) p
+     GROUP BY p.buyer, p.seller;
+$$;
+
 COMMIT;
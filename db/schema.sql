@@ -169,9 +169,43 @@ CREATE TABLE friendship
 , PRIMARY KEY (facebook_id, friend)
 , CHECK (facebook_id > 0)
 , CHECK (friend      > 0)
+, CHECK (facebook_id <> friend)
 );
 
 CREATE INDEX ON friendship (facebook_id);
+CREATE INDEX ON friendship (friend);
+
+-- Second degree friendships such that all second degree friends have
+-- accounts, with the number of mutual friends connecting them. Note
+-- that this table is not suitable as the basis for a third-degree
+-- friendship query, since third-degree friends may be connected through
+-- friends without accounts. Maintained by triggers on friendship and
+-- account; see procs.sql.
+CREATE TABLE second_degree_friendship
+( facebook_id bigint  NOT NULL REFERENCES account(facebook_id)
+, friend      bigint  NOT NULL REFERENCES account(facebook_id)
+, paths       integer NOT NULL
+
+, PRIMARY KEY (facebook_id, friend)
+, CHECK (facebook_id <> friend)
+, CHECK (paths >= 0)
+);
+
+CREATE INDEX ON second_degree_friendship (friend);
+
+-- Buyer and seller accounts connected by a friendship (degree 1) or
+-- through a mutual friend with an account (degree 2). Unconnected pairs
+-- have no row. Maintained by triggers on friendship and account; see
+-- procs.sql.
+CREATE TABLE connection
+( buyer  bigint   NOT NULL REFERENCES account(facebook_id)
+, seller bigint   NOT NULL REFERENCES account(facebook_id)
+, degree smallint NOT NULL
+
+, PRIMARY KEY (buyer, seller)
+, CHECK (buyer <> seller)
+, CHECK (degree IN (1, 2))
+);
 
 CREATE TABLE listing
 ( id          serial         PRIMARY KEY
@@ -194,24 +228,68 @@ CREATE TABLE claim
 , stripe_card      text        NOT NULL REFERENCES stripe_card
 );
 
+-- A checkout request identified by the client's idempotency key. An
+-- intent is recorded as pending before Stripe is called and finalized
+-- along with the claim it creates, so a retried request resumes the
+-- same checkout instead of starting another.
+CREATE TABLE checkout_intent
+( id              serial      PRIMARY KEY
+, created_at      timestamptz NOT NULL DEFAULT current_timestamp
+, account         integer     NOT NULL REFERENCES account
+, listing         integer     NOT NULL REFERENCES listing
+, idempotency_key text        NOT NULL
+, state           text        NOT NULL DEFAULT 'pending'
+, claim           integer     UNIQUE REFERENCES claim
+
+, UNIQUE (account, idempotency_key)
+, CHECK (length(idempotency_key) BETWEEN 1 AND 255)
+, CHECK (state IN ('pending', 'finalized'))
+, CHECK ((state = 'finalized') = (claim IS NOT NULL))
+);
+
 CREATE TABLE ticket
 ( id         serial      PRIMARY KEY
 , created_at timestamptz NOT NULL DEFAULT current_timestamp
 , claim      integer     NOT NULL UNIQUE REFERENCES claim
 );
 
+-- The filename is the path of the upload in the content addressed
+-- store under the API's upload directory; identical uploads share it.
 CREATE TABLE pdf
 ( ticket     integer     PRIMARY KEY REFERENCES ticket
 , created_at timestamptz NOT NULL DEFAULT current_timestamp
-, filename   text        NOT NULL UNIQUE
+, filename   text        NOT NULL
 
 , CHECK (length(filename) BETWEEN 1 AND 255)
 );
 
+-- Email waiting to be delivered by the API's outbox workers. A claimed
+-- message has its deliver_at pushed forward, so it is retried if the
+-- worker dies before recording the outcome.
+CREATE TABLE outbox
+( id           serial      PRIMARY KEY
+, created_at   timestamptz NOT NULL DEFAULT current_timestamp
+, sender       text        NOT NULL
+, recipient    text        NOT NULL
+, message      text        NOT NULL
+, attempts     integer     NOT NULL DEFAULT 0
+, deliver_at   timestamptz NOT NULL DEFAULT current_timestamp
+, delivered_at timestamptz
+, last_error   text
+
+, CHECK (attempts >= 0)
+);
+
+CREATE INDEX ON outbox (deliver_at) WHERE delivered_at IS NULL;
+
 ----------------------
 -- Search Relations --
 ----------------------
 
+-- Bumped by the ingest pipeline after it refreshes the search views;
+-- the API keys its search caches on the current value.
+CREATE SEQUENCE ingest_generation;
+
 CREATE MATERIALIZED VIEW venue_city AS
 SELECT v.id          AS venue
      , y.id          AS city
@@ -260,31 +338,5 @@ SELECT e.id AS id
 CREATE UNIQUE INDEX ON event_search (id) WITH (fillfactor=100);
 CREATE INDEX ON event_search USING gin (terms) WITH (fastupdate=off);
 
--- Force the query planner to use a nestloop plan for this query.
--- Ensure that when refreshing this view, the planner is correctly
--- hinted as well.
-SET enable_hashjoin = false;
-SET enable_mergejoin = false;
-
--- Second degree friendships such that all second degree friends have
--- accounts. Note that this view is not suitable as the basis for a
--- third-degree friendship query, since third-degree friends may be
--- connected through friends without accounts.
-CREATE MATERIALIZED VIEW second_degree_friendship AS
-SELECT f1.facebook_id AS facebook_id
-     , f2.facebook_id AS friend
-  FROM friendship f1
-  JOIN friendship f2
-    ON f1.friend = f2.facebook_id
-   AND f1.facebook_id <> f2.facebook_id
-  JOIN friendship f3
-    ON f2.friend = f3.facebook_id
- GROUP BY f1.facebook_id, f2.facebook_id;
-
-SET enable_hashjoin = default;
-SET enable_mergejoin = default;
-
-CREATE INDEX ON second_degree_friendship (facebook_id, friend);
-
 
 COMMIT;
@@ -93,21 +93,6 @@ SELECT c.*
 -- Ticket Views --
 ------------------
 
-CREATE OR REPLACE VIEW connectedness AS
-SELECT a1.facebook_id AS facebook_id
-     , a2.facebook_id AS friend
-     , f1.facebook_id AS first_degree
-     , f2.facebook_id AS second_degree
-  FROM account a1
-  JOIN account a2
-    ON a1.id <> a2.id
-  LEFT JOIN friendship f1
-    ON a1.facebook_id = f1.facebook_id
-   AND a2.facebook_id = f1.friend
-  LEFT JOIN second_degree_friendship f2
-    ON a1.facebook_id = f2.facebook_id
-   AND a2.facebook_id = f2.friend;
-
 CREATE OR REPLACE VIEW full_listings AS
 SELECT l.id             AS id
      , l.created_at     AS created_at
@@ -150,20 +135,6 @@ SELECT l.id             AS id
    AND m.id IS NULL
    AND e.datetime_utc > (current_timestamp - interval '5 minutes');
 
--- To find the connectedness for a particular buyer, filter on
--- the facebook_id of the buyer's account.
-CREATE OR REPLACE VIEW available_listings AS
-SELECT l.*
-     , c.facebook_id    AS buyer
-     , c.first_degree   AS first_degree
-     , c.second_degree  AS second_degree
-  FROM full_listings l
-  JOIN connectedness c
-    ON l.seller__facebook_id = c.friend
- ORDER BY c.first_degree ASC
-        , c.second_degree ASC
-        , l.event__datetime_utc ASC;
-
 CREATE OR REPLACE FUNCTION modify_listing_row()
     RETURNS trigger
     LANGUAGE plpgsql
@@ -112,4 +112,7 @@ REFRESH MATERIALIZED VIEW event_search;
 REFRESH MATERIALIZED VIEW performer_summary;
 COMMIT;
 
+-- Invalidate API search caches built from the old views
+SELECT nextval('ingest_generation');
+
 ANALYZE;
@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+
+import os; os.environ.setdefault('APP_ENV', 'development')
+import sys; sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+import itertools
+import subprocess
+import collections
+import SocketServer
+import BaseHTTPServer
+
+import stripe
+import requests
+import werkzeug.test
+import werkzeug.serving
+
+import api.app
+from api import db, trace
+
+
+parser = argparse.ArgumentParser(
+    description='Benchmark the API against the database named by the '
+    'PG* environment variables. Requests create listings and checkouts, '
+    'so use a scratch database.')
+parser.add_argument('-m', '--mode', choices=('inprocess', 'socket'),
+                    default='inprocess',
+                    help='Call the WSGI application directly, or over HTTP '
+                    'through a threaded server on localhost.')
+parser.add_argument('-n', '--requests', metavar='N', type=int, default=2000,
+                    help='Number of requests to measure.')
+parser.add_argument('-c', '--concurrency', metavar='N', type=int, default=8,
+                    help='Number of clients sending requests at once.')
+parser.add_argument('-w', '--warmup', metavar='N', type=int, default=200,
+                    help='Number of requests sent before measuring.')
+parser.add_argument('--mix', metavar='SCENARIO=WEIGHT,...',
+                    default='events=50,listings=25,account=10,'
+                    'create_listing=10,checkout=5',
+                    help='Relative frequency of each scenario.')
+parser.add_argument('--seed', metavar='N', type=int, default=0,
+                    help='Seed for choosing requests.')
+parser.add_argument('--scale', metavar='N', type=float,
+                    help='Regenerate the fixtures at this scale with '
+                    'scripts/genfixtures.py first.')
+parser.add_argument('--stripe-latency', metavar='SECONDS', type=float,
+                    default=0.05,
+                    help='Time taken by each call to the stubbed Stripe API.')
+parser.add_argument('--baseline', metavar='FILE',
+                    help='Compare against the report stored in FILE.')
+parser.add_argument('--save', metavar='FILE',
+                    help='Store the report in FILE, as a future baseline.')
+parser.add_argument('--tolerance', metavar='FRACTION', type=float,
+                    default=0.2,
+                    help='Slowdown over the baseline reported as a '
+                    'regression.')
+
+# Spans which are each a statement sent to the database.
+QUERY_SPANS = ('db.execute', 'db.callproc', 'db.copy')
+
+
+###############
+# Stubbed API #
+###############
+
+class StripeStub(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Answers the customer calls of `create_checkout' after a delay,
+    with a new card each time a customer is saved.'''
+
+    latency = 0
+    # unique across runs, as cards are stored
+    prefix = 'bench{0:x}x'.format(int(time.time()))
+    ids = itertools.count()
+
+    def new_id(self, kind):
+        return '{0}_{1}{2}'.format(kind, self.prefix, next(self.ids))
+
+    def log_message(self, *args):
+        pass
+
+    def customer(self, id, card=None):
+        card = card or self.new_id('card')
+        return {
+            'id': id, 'object': 'customer', 'default_card': card,
+            'cards': {'object': 'list',
+                      'url': '/v1/customers/{}/cards'.format(id),
+                      'data': [{'id': card, 'object': 'card',
+                                'exp_year': 2030, 'exp_month': 1,
+                                'fingerprint': 'benchfingerprint',
+                                'name': 'Bench Mark', 'last4': '4242',
+                                'type': 'Visa'}]},
+        }
+
+    def reply(self, body):
+        time.sleep(self.latency)
+        data = json.dumps(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.reply(self.customer(self.path.rsplit('/', 1)[1], 'card_bench'))
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = self.path.split('?')[0].rstrip('/').split('/')
+        self.reply(self.customer(path[3] if len(path) > 3 else
+                                 self.new_id('cus')))
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://{0}:{1}'.format(*server.server_address)
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def start_stripe(latency):
+    StripeStub.latency = latency
+    stripe.api_base = serve(ThreadingHTTPServer(('127.0.0.1', 0), StripeStub))
+
+
+#############
+# Scenarios #
+#############
+
+class Dataset(object):
+    '''What requests are made about: accounts, the events of each city,
+    and the listings still open to checkout.'''
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.lock = threading.Lock()
+        with db.connect(readonly=True):
+            self.accounts = [row[0] for row in db.execute(
+                'SELECT id FROM account ORDER BY id', ())]
+            self.events = collections.defaultdict(list)
+            for city, id, title in db.execute(
+                    'SELECT city__id, id, title FROM full_event_search '
+                    ' ORDER BY id', ()):
+                self.events[city].append((id, title))
+            self.listings = list(db.execute(
+                'SELECT id, seller__id FROM full_listings ORDER BY id', ()))
+        if not self.accounts or not self.events:
+            raise SystemExit('no accounts or upcoming events to benchmark')
+        rng.shuffle(self.listings)
+        self.sizes = {'accounts': len(self.accounts),
+                      'events': sum(map(len, self.events.itervalues())),
+                      'listings': len(self.listings)}
+
+    def account(self):
+        return self.rng.choice(self.accounts)
+
+    def city(self):
+        return self.rng.choice(sorted(self.events))
+
+    def event(self, city=None):
+        return self.rng.choice(self.events[city or self.city()])
+
+    def take_listing(self, buyer):
+        with self.lock:
+            for i, (listing, seller) in enumerate(self.listings):
+                if seller != buyer:
+                    return self.listings.pop(i)[0]
+
+    def add_listing(self, listing, seller):
+        with self.lock:
+            self.listings.append((listing, seller))
+
+def events(client, data):
+    '''Autocomplete: a query for each prefix of a word being typed.'''
+    city = data.city()
+    words = [word for word in data.event(city)[1].split() if len(word) > 2]
+    word = data.rng.choice(words or ['the'])
+    for end in xrange(2, len(word) + 1):
+        client.request('GET search_events', 'GET', '/events',
+                       query={'city': city, 'q': word[:end]})
+
+def listings(client, data):
+    client.request('GET search_listings', 'GET', '/listings',
+                   query={'city': data.city()}, account=data.account())
+
+def account(client, data):
+    client.request('GET view_account', 'GET', '/account',
+                   account=data.account())
+
+def create_listing(client, data):
+    seller = data.account()
+    response = client.request(
+        'POST create_listing', 'POST', '/listings', account=seller,
+        body={'event': data.event()[0],
+              'price': data.rng.randint(1, 400) * 50})
+    if response is not None:
+        data.add_listing(response['id'], seller)
+
+def checkout(client, data):
+    buyer = data.account()
+    listing = data.take_listing(buyer)
+    if listing is None:
+        return create_listing(client, data)
+    client.request('POST create_checkout', 'POST', '/checkouts', account=buyer,
+                   body={'listing': listing, 'card_token': 'tok_bench'})
+
+SCENARIOS = {
+    'events': events,
+    'listings': listings,
+    'account': account,
+    'create_listing': create_listing,
+    'checkout': checkout,
+}
+
+
+###########
+# Clients #
+###########
+
+class Client(object):
+    '''Sends requests for one simulated user at a time, recording the
+    latency and status of each under the name of its handler.'''
+
+    def __init__(self, application, results):
+        self.application = application
+        self.results = results
+        self.sent = 0
+
+    def request(self, route, method, path, query=None, body=None,
+                account=None):
+        headers = {}
+        if account is not None:
+            headers['Cookie'] = 'session=' + api.app.SecureCookie(
+                {'account': account},
+                secret_key=api.app.SECRET_KEY).serialize()
+        data = None if body is None else json.dumps(body)
+        if data is not None:
+            headers['Content-Type'] = 'application/json'
+        self.sent += 1
+        started = time.time()
+        status, content = self.send(method, path, query, data, headers)
+        self.results.record(route, time.time() - started, status)
+        if status == 200:
+            return json.loads(content)
+
+class InProcessClient(Client):
+
+    def send(self, method, path, query, data, headers):
+        environ = werkzeug.test.EnvironBuilder(
+            path, method=method, query_string=query, data=data,
+            headers=headers).get_environ()
+        # buffering closes the response, releasing its connection
+        body, status, headers = werkzeug.test.run_wsgi_app(
+            self.application, environ, buffered=True)
+        return int(status.split()[0]), str.join('', body)
+
+class SocketClient(Client):
+
+    def __init__(self, url, results):
+        super(SocketClient, self).__init__(url, results)
+        self.session = requests.Session()
+
+    def send(self, method, path, query, data, headers):
+        response = self.session.request(method, self.application + path,
+                                        params=query, data=data,
+                                        headers=headers)
+        return response.status_code, response.content
+
+def quiet(application):
+    '''Discard what handlers log about each request.'''
+    errors = open(os.devnull, 'w')
+    def _quiet(environ, start_response):
+        environ['wsgi.errors'] = errors
+        return application(environ, start_response)
+    return _quiet
+
+
+###########
+# Results #
+###########
+
+class Results(object):
+    '''Latencies and statuses of the requests to each route, and the
+    number of queries made by the handler of each route.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.recording = False
+        self.latencies = collections.defaultdict(list)
+        self.statuses = collections.defaultdict(collections.Counter)
+        self.queries = collections.defaultdict(list)
+        self.started = self.finished = None
+        trace.subscribe(self.traced)
+
+    def start(self):
+        self.recording, self.started = True, time.time()
+
+    def stop(self):
+        self.recording, self.finished = False, time.time()
+
+    def record(self, route, seconds, status):
+        if self.recording:
+            with self.lock:
+                self.latencies[route].append(seconds)
+                self.statuses[route][status] += 1
+
+    def traced(self, trace):
+        if self.recording:
+            with self.lock:
+                self.queries[trace.name].append(
+                    sum(trace.calls[name] for name in QUERY_SPANS))
+
+    def report(self, sizes, settings):
+        elapsed = self.finished - self.started
+        routes = {}
+        for route, latencies in self.latencies.iteritems():
+            latencies.sort()
+            queries = self.queries.get(route) or [0]
+            routes[route] = {
+                'requests': len(latencies),
+                'errors': sum(n for status, n in
+                              self.statuses[route].iteritems()
+                              if status >= 400),
+                'throughput': len(latencies) / elapsed,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'queries': float(sum(queries)) / len(queries),
+            }
+        return {
+            'dataset': sizes,
+            'settings': settings,
+            'elapsed': elapsed,
+            'throughput': sum(map(len, self.latencies.values())) / elapsed,
+            'routes': routes,
+        }
+
+def percentile(values, p):
+    '''The `p'th percentile of the sorted `values', by nearest rank.'''
+    return values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+
+def print_report(report):
+    print 'dataset: {}'.format(', '.join(
+        '{0} {1}'.format(n, name)
+        for name, n in sorted(report['dataset'].iteritems())))
+    print '{mode}, {concurrency} clients'.format(**report['settings'])
+    print '{0:.1f} requests/s over {1:.1f}s'.format(
+        report['throughput'], report['elapsed'])
+    print
+    print '{0:<22}{1:>7}{2:>7}{3:>8}{4:>9}{5:>9}{6:>9}{7:>9}'.format(
+        'route', 'reqs', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+        'queries')
+    for route, stats in sorted(report['routes'].iteritems()):
+        print ('{0:<22}{requests:>7}{errors:>7}{throughput:>8.1f}'
+               '{p50_ms:>9.2f}{p95_ms:>9.2f}{p99_ms:>9.2f}'
+               '{queries:>9.1f}').format(route, **stats)
+
+def regressions(report, baseline, tolerance):
+    '''Describe each route which is slower, or makes more queries, than
+    in the `baseline' report.'''
+    for route, old in sorted(baseline['routes'].iteritems()):
+        new = report['routes'].get(route)
+        if new is None:
+            continue
+        for stat in 'p50_ms', 'p95_ms', 'p99_ms':
+            if new[stat] > old[stat] * (1 + tolerance):
+                yield '{0}: {1} {2:.2f} -> {3:.2f}'.format(
+                    route, stat, old[stat], new[stat])
+        if round(new['queries'], 1) > round(old['queries'], 1):
+            yield '{0}: queries {1:.1f} -> {2:.1f}'.format(
+                route, old['queries'], new['queries'])
+
+
+########
+# Main #
+########
+
+def run(clients, data, mix, count):
+    '''Have `clients' play scenarios drawn from `mix' until they have
+    sent `count' more requests.'''
+    scenarios = [SCENARIOS[name] for name, weight in mix
+                 for _ in xrange(weight)]
+    count += sum(client.sent for client in clients)
+    def play(client):
+        while sum(client.sent for client in clients) < count:
+            data.rng.choice(scenarios)(client, data)
+    threads = [threading.Thread(target=play, args=(client,))
+               for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def parse_mix(mix):
+    weights = [item.split('=') for item in mix.split(',')]
+    for name, weight in weights:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario {}'.format(name))
+    return [(name, int(weight)) for name, weight in weights]
+
+def main():
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+    if args.scale is not None:
+        subprocess.check_call([
+            os.path.join(os.path.dirname(__file__), 'genfixtures.py'),
+            '--scale', str(args.scale), '--seed', str(args.seed)])
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    start_stripe(args.stripe_latency)
+
+    data = Dataset(random.Random(args.seed))
+    results = Results()
+    application = quiet(api.app.router)
+    if args.mode == 'socket':
+        url = serve(werkzeug.serving.make_server(
+            '127.0.0.1', 0, application, threaded=True))
+        clients = [SocketClient(url, results)
+                   for _ in xrange(args.concurrency)]
+    else:
+        clients = [InProcessClient(application, results)
+                   for _ in xrange(args.concurrency)]
+
+    run(clients, data, mix, args.warmup)
+    results.start()
+    run(clients, data, mix, args.requests)
+    results.stop()
+
+    report = results.report(data.sizes, {'mode': args.mode,
+                                         'concurrency': args.concurrency,
+                                         'mix': dict(mix)})
+    print_report(report)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = list(regressions(report, baseline, args.tolerance))
+        print
+        for setup in 'dataset', 'settings':
+            if report[setup] != baseline[setup]:
+                print 'warning: the baseline {0} was {1}'.format(
+                    setup, json.dumps(baseline[setup], sort_keys=True))
+        print 'regressions:' if found else 'no regressions'
+        for regression in found:
+            print '  ' + regression
+        sys.exit(1 if found else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import os; os.environ.setdefault('APP_ENV', 'development')
+import sys; sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import argparse
+import threading
+import traceback
+
+from api import db
+
+parser = argparse.ArgumentParser(
+    description='Check the behaviour of the database layer against a '
+    'development database.')
+parser.add_argument('checks', metavar='CHECK', nargs='*',
+                    help='Run only these checks.')
+
+checks = []
+
+def check(func):
+    checks.append(func)
+    return func
+
+
+##########
+# Checks #
+##########
+
+@check
+def prepared_parameters():
+    '''Prepared statements refuse parameters which the server would
+    otherwise cast to the parameter type by assignment.'''
+    query = 'SELECT id FROM account WHERE id = %s'
+    with db.connect():
+        list(db.execute(query, (1,), prepared=True))
+        list(db.execute(query, (None,), prepared=True))
+        for value in 1.6, '1', True:
+            try:
+                list(db.execute(query, (value,), prepared=True))
+            except db.ParameterError:
+                continue
+            raise AssertionError('{!r} accepted for an integer'.format(value))
+
+@check
+def concurrent_friendships():
+    '''Friendships making up a path, inserted or deleted by two
+    transactions at once, count the path exactly once.'''
+    with db.connect():
+        first = db.execute_one(
+            'SELECT greatest(max(a.facebook_id), max(f.friend)) + 1 '
+            '  FROM account a, friendship f', ())[0]
+        a, b, c = ids = range(first, first + 3)
+        for facebook_id in ids:
+            db.callproc('replace_account', facebook_id,
+                        'checkdb-{}@example.com'.format(facebook_id),
+                        'Check {}'.format(facebook_id), 'token', 'UTC', None)
+    try:
+        concurrently('INSERT INTO friendship (facebook_id, friend) '
+                     'VALUES (%s, %s)', (a, b), (b, c))
+        assert paths(a, c) == (1, 2), paths(a, c)
+        concurrently('DELETE FROM friendship '
+                     ' WHERE facebook_id = %s AND friend = %s', (a, b), (b, c))
+        assert paths(a, c) == (None, None), paths(a, c)
+    finally:
+        with db.connect():
+            db.execute('DELETE FROM friendship WHERE facebook_id = ANY(%s)',
+                       (ids,))
+            db.execute('DELETE FROM account WHERE facebook_id = ANY(%s)',
+                       (ids,))
+
+def concurrently(query, *params):
+    '''Run `query' once for each of `params', each in a transaction of
+    its own, and keep all of them open until the others have run theirs
+    or have been blocked for a second.'''
+    ran = [threading.Event() for _ in params]
+    errors = []
+    def run(i):
+        try:
+            with db.connect():
+                db.execute(query, params[i])
+                ran[i].set()
+                for event in ran:
+                    event.wait(1)
+        except Exception, e:
+            errors.append(e)
+        finally:
+            ran[i].set()
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in xrange(len(params))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def paths(buyer, seller):
+    '''The second degree paths and the connection from `buyer' to
+    `seller'.'''
+    with db.connect():
+        return db.execute_one(
+            '''SELECT (SELECT paths
+                         FROM second_degree_friendship
+                        WHERE facebook_id = %s AND friend = %s)
+                    , (SELECT degree
+                         FROM connection
+                        WHERE buyer = %s AND seller = %s)''',
+            (buyer, seller, buyer, seller))
+
+
+###########
+# Startup #
+###########
+
+def main():
+    args = parser.parse_args()
+    failed = 0
+    for func in checks:
+        if args.checks and func.__name__ not in args.checks:
+            continue
+        try:
+            func()
+        except Exception:
+            traceback.print_exc()
+            failed += 1
+            sys.stdout.write('FAIL {}\n'.format(func.__name__))
+        else:
+            sys.stdout.write('ok   {}\n'.format(func.__name__))
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
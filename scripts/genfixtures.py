@@ -1,20 +1,65 @@
 #!/usr/bin/env python
 
 import os
-import sys
-import pytz
+import sys; sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 import random
 import string
-import StringIO
+import hashlib
+import argparse
 import datetime
-import operator
 import itertools
+import multiprocessing
 
 import psycopg2
 
+from api.db import RowStream
+
 os.environ.setdefault('PGDATABASE', 'bazaar')
-db = psycopg2.connect('')
-cursor = db.cursor()
+
+ACCOUNTS_PER_SCALE = 256
+LISTINGS_PER_ACCOUNT = 2
+CHUNK_SIZE = 10000              # rows generated from one random seed
+FIRST_ACCOUNT = 3               # accounts 1 and 2 come from development.sql
+FACEBOOK_ID_BASE = 10 ** 14     # facebook id of account 0
+OUTSIDE_FACEBOOK_IDS = (2 * 10 ** 14, 3 * 10 ** 14) # friends without accounts
+
+# Friends with accounts: degrees follow a Pareto distribution, and each
+# account befriends older accounts, favouring the oldest, so that early
+# accounts become hubs.
+MIN_FRIENDS = 2
+FRIENDS_SHAPE = 1.5
+MAX_FRIENDS = 5000
+FRIEND_AGE_SKEW = 1.5
+MAX_OUTSIDE_FRIENDS = 40
+
+CLAIMED = 0.4                   # fraction of listings claimed
+TICKETED = 0.6                  # fraction of claims with a ticket
+UPLOADED = 0.6                  # fraction of tickets with a pdf
+
+# Triggers maintaining tables rebuilt by rebuild_connection()
+DERIVED_TRIGGERS = [
+    ('account', 'maintain_connection'),
+    ('friendship', 'maintain_second_degree_friendship'),
+    ('friendship', 'maintain_connection'),
+]
+
+parser = argparse.ArgumentParser(
+    description='Replace the generated fixtures: accounts, friendships, '
+    'listings, and the cards, claims, tickets and pdfs which go with them. '
+    'The same scale and seed always generate the same rows.')
+parser.add_argument('-s', '--scale', metavar='N', type=float, default=1,
+                    help='Generate {} accounts per unit.'.format(
+                        ACCOUNTS_PER_SCALE))
+parser.add_argument('--seed', metavar='N', type=int, default=0,
+                    help='Seed of the random generators.')
+parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                    help='Load chunks of each table over this many '
+                    'connections. More than one commits each chunk on its '
+                    'own rather than loading everything in one transaction.')
+parser.add_argument('--words', metavar='FILE',
+                    default='/usr/share/dict/words')
+parser.add_argument('--names', metavar='FILE',
+                    default='/usr/share/dict/propernames')
 
 tlds = '''agrigento.it aid.pl ako.hyogo.jp asker.no asso.bj bv.nl c.bg
 carrara-massa.it de.us edu.km eid.no environment.museum firenze.it
@@ -28,172 +73,253 @@ raisa.no riik.ee s3-us-gov-west-1.amazonaws.com selfip.com
 shioya.tochigi.jp snaase.no toyako.hokkaido.jp trust.museum tw.cn
 uchinomi.kagawa.jp vaapste.no vestnes.no wassamu.hokkaido.jp'''.split()
 
-def fetchall():
-    while True:
-        row = cursor.fetchone()
-        if row is None:
-            break
-        yield row
+chars = list(set(string.letters) - set(string.whitespace))
 
-r = random.Random()
-with file('/usr/share/dict/words') as f:
-    words = [w.strip() for w in f]
+brands = ['Visa', 'American Express', 'Mastercard', 'Discover', 'JCB',
+          'Diners Club', None]
 
-try:
-    with file('/usr/share/dict/propernames') as f:
-        names = [w.strip() for w in f]
-except IOError:
-    names = words
+class Fixtures(object):
+    '''Generates the rows of each table in chunks of CHUNK_SIZE ids,
+    each from a generator seeded by the table and the chunk, so that
+    chunks can be generated in any order and by any process. Rows which
+    refer to other tables are derived from the same ids rather than
+    looked up.'''
 
-def randrange(upper=100, lower=None):
-    if lower is None:
-        lower = 8
-    return xrange(1, r.randint(lower, upper))
+    def __init__(self, seed, scale, events, timezones, facebook_ids,
+                 words, names):
+        self.seed = seed
+        self.accounts = xrange(FIRST_ACCOUNT, FIRST_ACCOUNT +
+                               int(ACCOUNTS_PER_SCALE * scale))
+        self.listings = xrange(1, 1 + LISTINGS_PER_ACCOUNT *
+                               len(self.accounts))
+        self.events = events
+        self.timezones = timezones
+        self.existing_facebook_ids = facebook_ids
+        self.words = words
+        self.names = names
 
-chars = list(set(string.letters) - set(string.whitespace))
+    def random(self, table, lo):
+        return random.Random(int(hashlib.sha1('{0}:{1}:{2}'.format(
+            self.seed, table, lo)).hexdigest(), 16))
+
+    def facebook_id(self, account):
+        return self.existing_facebook_ids.get(account,
+                                              FACEBOOK_ID_BASE + account)
+
+    @staticmethod
+    def has_customer(account):
+        return account % 4 != 0
+
+    @staticmethod
+    def randstr(r, maxlen=100, minlen=8):
+        return str.join('', [r.choice(chars)
+                             for _ in xrange(r.randint(minlen, maxlen))])
+
+    def randword(self, r):
+        return r.choice(self.words)[:24]
+
+    def randname(self, r):
+        return '{0} {1}'.format(r.choice(self.names)[:40],
+                                self.randword(r).title())
+
+    def account_rows(self, lo, hi):
+        r = self.random('account', lo)
+        for pk in xrange(lo, hi):
+            yield (pk, self.facebook_id(pk),
+                   '{0}.{1}@{2}.{3}'.format(
+                       self.randword(r)[:12], pk, self.randword(r)[:12],
+                       r.choice(tlds)),
+                   self.randname(r),
+                   self.randstr(r, 64, 64),
+                   r.choice(self.timezones),
+                   'http://{0}.{1}/{2}'.format(self.randword(r),
+                                               r.choice(tlds),
+                                               self.randstr(r, 16)))
+
+    def stripe_customer_rows(self, lo, hi):
+        for account in xrange(lo, hi):
+            if self.has_customer(account):
+                yield 'cus_fixture{}'.format(account), account
+
+    def stripe_card_rows(self, lo, hi):
+        r = self.random('stripe_card', lo)
+        today = datetime.date.today()
+        for account in xrange(lo, hi):
+            if self.has_customer(account):
+                expiration = today + datetime.timedelta(r.randint(0, 3650))
+                yield ('card_fixture{}'.format(account),
+                       'cus_fixture{}'.format(account),
+                       self.randstr(r, 16, 16),
+                       self.randname(r),
+                       expiration.replace(day=1),
+                       r.randint(1001, 9999),
+                       r.choice(brands))
 
-def randstr(maxlen=100, minlen=None):
-    return str.join('', [r.choice(chars)
-                         for _ in randrange(maxlen, minlen)])
-
-def randword():
-    return r.choice(words)
-
-def random_email():
-    return '{0}@{1}.{2}'.format(randword(), randword(), random.choice(tlds))
-
-def random_url():
-    return 'http://{0}.{1}/{2}'.format(
-        randword(), random.choice(tlds), randstr(16))
-
-
-def fetch_events():
-    cursor.execute('TABLE seatgeek_event')
-    for row in fetchall():
-        yield row[0], row[1:]
-
-def generate_accounts():
-    for pk in randrange(256):
-        yield pk+2, (
-            r.randint(100, 1000000), # facebook_id
-            random_email(),          # email
-            '{0} {1}'.format(r.choice(names), randword().title()), # full_name
-            randstr(64),      # access_token
-            r.choice(pytz.all_timezones),
-            random_url(),       # profile
-        )
-
-def generate_listings(accounts, events):
-    pk = itertools.count()
-    num_sellers = r.randint(4, max(len(accounts)/2, 8))
-    for seller in r.sample(accounts.keys(), num_sellers):
-        for event in [r.choice(events.keys()) for _ in randrange(16, 0)]:
-            yield next(pk), (
-                event,
-                seller,
-                50 * r.randint(0, 300), # price
-                r.choice([
-                    None,
-                    ' '.join(randword() for _ in randrange(20)),
-                ]),         # message
-            )
-
-def generate_customers(accounts):
-    num_accounts = r.randint(4, len(accounts))
-    for account in r.sample(accounts.keys(), num_accounts):
-        customer = 'cus_{}'.format(randstr(24))
-        yield customer, (account,)
-
-def generate_cards(accounts, customers):
-    num_customers = r.randint(3*len(customers)/4, len(customers))
-    now = datetime.datetime.now(pytz.utc).date()
-    for customer in r.sample(customers.keys(), num_customers):
-        expiration = now + datetime.timedelta(r.randint(0, 3650))
-        card = 'card_{}'.format(randstr(24))
-        yield card, (
-            customer,
-            randstr(17, 17),      # fingerprint
-            accounts[customers[customer][0]][2], # full_name
-            str(expiration.replace(day=1)),
-            r.randint(1001, 9999), # card_last4
-            r.choice([
-                'Visa',
-                'American Express',
-                'Mastercard',
-                'Discover',
-                'JCB',
-                'Diners Club',
-                None,
-            ]),                 # card_type
-        )
-
-def generate_claims(cards, listings):
-    pk = itertools.count()
-    min_len = min(len(cards), len(listings))
-    num_listings = r.randint(min(min_len, 4), 3*min_len/4)
-    for listing in r.sample(listings.keys(), num_listings):
-        card = r.choice(list(cards.viewkeys() - {listings[listing][1]}))
-        yield next(pk), (listing, card)
-
-def generate_tickets(claims):
-    pk = itertools.count()
-    num_claims = r.randint(2, len(claims))
-    for claim in r.sample(claims.keys(), num_claims):
-        yield next(pk), (claim,)
-
-def generate_pdfs(tickets):
-    num_tickets = r.randint(2, len(tickets))
-    for ticket in r.sample(tickets.keys(), num_tickets):
-        yield ticket, (randstr(24),)
-
-def as_file(d):
-    s = StringIO.StringIO()
-    for k, r in d.iteritems():
-        s.write('{0}\t{1}\n'.format(str(k), '\t'.join([
-            r'\N' if val is None else str(val)
-            for val in r])))
-    s.seek(0)
-    return s
+    def friendship_rows(self, lo, hi):
+        '''Each friendship between accounts is generated, in both
+        directions, along with the younger account.'''
+        r = self.random('friendship', lo)
+        for account in xrange(lo, hi):
+            me = self.facebook_id(account)
+            older = account - 1
+            degree = min(int(MIN_FRIENDS * r.paretovariate(FRIENDS_SHAPE)),
+                         MAX_FRIENDS, older // 2)
+            friends = set()
+            for _ in xrange(4 * degree):
+                if len(friends) == degree:
+                    break
+                friend = 1 + int(older * r.random() ** FRIEND_AGE_SKEW)
+                if friend >= FIRST_ACCOUNT or \
+                        friend in self.existing_facebook_ids:
+                    friends.add(friend)
+            for friend in friends:
+                yield me, self.facebook_id(friend)
+                yield self.facebook_id(friend), me
+            outside = set(r.randrange(*OUTSIDE_FACEBOOK_IDS)
+                          for _ in xrange(r.randint(0, MAX_OUTSIDE_FRIENDS)))
+            for friend in outside:
+                yield me, friend
+
+    def listing_rows(self, lo, hi):
+        r = self.random('listing', lo)
+        for pk in xrange(lo, hi):
+            yield (pk,
+                   r.choice(self.events),
+                   r.choice(self.accounts),           # seller
+                   50 * r.randint(0, 300),            # price
+                   r.choice([
+                       None,
+                       str.join(' ', [self.randword(r)
+                                      for _ in xrange(r.randint(1, 20))]),
+                   ]))                                # message
+
+    def claim_rows(self, lo, hi):
+        '''Claims share the id of their listing.'''
+        r = self.random('claim', lo)
+        for listing, _, seller, _, _ in self.listing_rows(lo, hi):
+            if r.random() < CLAIMED:
+                for _ in xrange(16):
+                    buyer = r.choice(self.accounts)
+                    if buyer != seller and self.has_customer(buyer):
+                        yield listing, listing, 'card_fixture{}'.format(buyer)
+                        break
+
+    def ticket_rows(self, lo, hi):
+        '''Tickets share the id of their claim.'''
+        r = self.random('ticket', lo)
+        for claim, _, _ in self.claim_rows(lo, hi):
+            if r.random() < TICKETED:
+                yield claim, claim
+
+    def pdf_rows(self, lo, hi):
+        r = self.random('pdf', lo)
+        for ticket, _ in self.ticket_rows(lo, hi):
+            if r.random() < UPLOADED:
+                digest = '{:064x}'.format(r.getrandbits(256))
+                yield ticket, '{0}/{1}/{2}.pdf'.format(digest[:2],
+                                                       digest[2:4], digest)
+
+    def chunks(self, ids):
+        return [(lo, min(lo + CHUNK_SIZE, ids[-1] + 1))
+                for lo in xrange(ids[0], ids[-1] + 1, CHUNK_SIZE)] \
+               if ids else []
+
+# Tables in the order they are loaded, with their columns and the ids
+# they are generated over.
+tables = [
+    ('account', ('id', 'facebook_id', 'email', 'full_name', 'access_token',
+                 'tz', 'profile'), 'accounts'),
+    ('stripe_customer', ('id', 'account'), 'accounts'),
+    ('stripe_card', ('id', 'customer', 'fingerprint', 'full_name',
+                     'expiration', 'last4', 'brand'), 'accounts'),
+    ('friendship', ('facebook_id', 'friend'), 'accounts'),
+    ('listing', ('id', 'event', 'seller', 'price', 'message'), 'listings'),
+    ('claim', ('id', 'listing', 'stripe_card'), 'listings'),
+    ('ticket', ('id', 'claim'), 'listings'),
+    ('pdf', ('ticket', 'filename'), 'listings'),
+]
+
+fixtures = None                 # inherited by the worker processes
+connection = None               # of this worker process
+
+def copy_chunk(cursor, table, columns, lo, hi):
+    '''Stream the rows of `table' with ids from `lo' to `hi' into COPY
+    as they are generated.'''
+    rows = getattr(fixtures, '{}_rows'.format(table))(lo, hi)
+    cursor.copy_from(RowStream(rows), table, size=65536, columns=columns)
+
+def connect_worker():
+    global connection
+    connection = psycopg2.connect('')
+
+def load_chunk(task):
+    with connection:
+        copy_chunk(connection.cursor(), *task)
+
+def read_lines(path, fallback=None):
+    try:
+        with file(path) as f:
+            return [line.strip() for line in f if line.strip()]
+    except IOError:
+        if fallback is None:
+            raise
+        return fallback
+
+def set_derived_triggers(cursor, enabled):
+    for table, trigger in DERIVED_TRIGGERS:
+        cursor.execute('ALTER TABLE {0} {1} TRIGGER {2}'.format(
+            table, 'ENABLE' if enabled else 'DISABLE', trigger))
 
 def main():
-    events = dict(fetch_events())
-    accounts = dict(generate_accounts())
-    listings = dict(generate_listings(accounts, events))
-    customers = dict(generate_customers(accounts))
-    cards = dict(generate_cards(accounts, customers))
-    claims = dict(generate_claims(cards, listings))
-    tickets = dict(generate_tickets(claims))
-    pdfs = dict(generate_pdfs(tickets))
-
-    cursor.execute('TRUNCATE stripe_customer CASCADE')
-    cursor.execute('TRUNCATE listing CASCADE')
-    cursor.execute('DELETE FROM account WHERE id > %s', (2,))
-
-    cursor.copy_from(
-        as_file(accounts), 'account',
-        columns=('id', 'facebook_id', 'email', 'full_name',
-                 'access_token', 'tz', 'profile'))
-    cursor.copy_from(
-        as_file(listings), 'listing',
-        columns=('id', 'event', 'seller', 'price', 'message'))
-    cursor.copy_from(
-        as_file(customers), 'stripe_customer',
-        columns=('id', 'account'))
-    cursor.copy_from(
-        as_file(cards), 'stripe_card',
-        columns=('id', 'customer', 'fingerprint', 'full_name',
-                 'expiration', 'last4', 'brand'))
-    cursor.copy_from(as_file(claims), 'claim',
-                     columns=('id', 'listing', 'stripe_card'))
-    cursor.copy_from(as_file(tickets), 'ticket',
-                     columns=('id', 'claim'))
-    cursor.copy_from(as_file(pdfs), 'pdf',
-                     columns=('ticket', 'filename'))
+    global fixtures
+    args = parser.parse_args()
+    db = psycopg2.connect('')
+    cursor = db.cursor()
+
+    cursor.execute('SELECT id FROM seatgeek_event ORDER BY id')
+    events = [row[0] for row in cursor]
+    cursor.execute('SELECT name FROM time_zones ORDER BY name')
+    timezones = [row[0] for row in cursor]
+    cursor.execute('SELECT id, facebook_id FROM account WHERE id < %s',
+                   (FIRST_ACCOUNT,))
+    facebook_ids = dict(cursor)
+    words = read_lines(args.words)
+    fixtures = Fixtures(args.seed, args.scale, events, timezones,
+                        facebook_ids, words, read_lines(args.names, words))
+
+    cursor.execute('TRUNCATE friendship, second_degree_friendship, '
+                   'connection, stripe_customer, listing CASCADE')
+    cursor.execute('DELETE FROM account WHERE id >= %s', (FIRST_ACCOUNT,))
+    # maintaining second degree friendships row by row is quadratic;
+    # they are rebuilt at once below
+    set_derived_triggers(cursor, False)
+
+    tasks = [[(table, columns) + chunk
+              for chunk in fixtures.chunks(getattr(fixtures, ids))]
+             for table, columns, ids in tables]
+    if args.jobs > 1:
+        db.commit()             # workers only see what is committed
+        try:
+            pool = multiprocessing.Pool(args.jobs, connect_worker)
+            for table_tasks in tasks:
+                pool.map(load_chunk, table_tasks, chunksize=1)
+            pool.close()
+        finally:
+            set_derived_triggers(cursor, True)
+            db.commit()
+    else:
+        for task in itertools.chain.from_iterable(tasks):
+            copy_chunk(cursor, *task)
+        set_derived_triggers(cursor, True)
+    cursor.execute('SELECT rebuild_connection()')
 
     for table in ['account', 'listing', 'claim', 'ticket']:
         cursor.execute("SELECT setval('{0}_id_seq', "
                        "(SELECT MAX(id) FROM {0}))".format(table))
-    cursor.execute('COMMIT')
+    for table, _, _ in tables + [('second_degree_friendship', None, None),
+                                 ('connection', None, None)]:
+        cursor.execute('ANALYZE {}'.format(table))
+    db.commit()
 
 if __name__ == '__main__':
     main()
@@ -7,6 +7,7 @@ import werkzeug.wsgi
 import werkzeug.serving
 
 import api.app
+import api.outbox
 
 
 ###########
@@ -29,6 +30,9 @@ def main():
     if args.static:
         application = werkzeug.wsgi.SharedDataMiddleware(
             application, {'/': args.static})
+    # the reloader serves from a child process running this again
+    if not args.use_reloader or os.environ.get('WERKZEUG_RUN_MAIN'):
+        api.outbox.start()
     werkzeug.serving.run_simple(args.addr, args.port, application,
                                 use_reloader=args.use_reloader)
 
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+import os; os.environ.setdefault('APP_ENV', 'production')
+import sys; sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import time
+import errno
+import Queue
+import random
+import select
+import signal
+import argparse
+import threading
+import traceback
+import werkzeug.wsgi
+import werkzeug.serving
+
+# Imported before forking, so that workers share the loaded code and
+# start serving at once.
+import api.app
+import api.db
+import api.outbox
+
+
+###########
+# Workers #
+###########
+
+class Server(werkzeug.serving.BaseWSGIServer):
+    '''Serves requests on `threads' threads of each worker process
+    forked from the process which created it, all accepting from the
+    same listening socket. A worker stops accepting once it has handled
+    `max_requests' requests or is asked to stop, and exits once the
+    requests it has accepted are done.'''
+
+    multithread = True
+    multiprocess = True
+    timeout = 1                 # seconds between checks for a stop
+
+    def __init__(self, host, port, app, threads, max_requests):
+        werkzeug.serving.BaseWSGIServer.__init__(self, host, port, app)
+        # losing the race to accept a connection must not block
+        self.socket.setblocking(0)
+        self.threads = threads
+        self.max_requests = max_requests
+        self.stopping = False
+
+    def run(self):
+        '''Serve requests in a worker process until stopped.'''
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        random.seed()
+        api.outbox.start()
+        queue = Queue.Queue(self.threads)
+        threads = [threading.Thread(target=self.work, args=(queue,),
+                                    name='worker-{}'.format(i))
+                   for i in xrange(self.threads)]
+        for thread in threads:
+            thread.start()
+        # spread out recycling, so workers do not restart all at once
+        limit = self.max_requests + random.randint(0, self.max_requests / 10) \
+                if self.max_requests else None
+        handled = 0
+        while not self.stopping and (limit is None or handled < limit):
+            try:
+                request, client_address = self.get_request()
+            except IOError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    self.wait()
+                    continue
+                raise
+            queue.put((request, client_address))
+            handled += 1
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def wait(self):
+        try:
+            select.select([self], [], [], self.timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+    def work(self, queue):
+        for request, client_address in iter(queue.get, None):
+            request.setblocking(1)
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+
+##############
+# Supervisor #
+##############
+
+def spawn(server):
+    pid = os.fork()
+    if pid != 0:
+        return pid
+    status = 1
+    try:
+        server.run()
+        status = 0
+    except:
+        traceback.print_exc()
+    finally:
+        os._exit(status)
+
+def supervise(server, processes, graceful_timeout):
+    '''Keep `processes' workers running until asked to stop, then give
+    them up to `graceful_timeout' seconds to finish their requests.'''
+    stopping = []
+    def stop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    workers = {}                # started at, by pid
+    while not stopping:
+        while len(workers) < processes:
+            workers[spawn(server)] = time.time()
+        try:
+            pid, status = os.wait()
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+            continue
+        started_at = workers.pop(pid)
+        if status != 0:
+            sys.stderr.write('worker {0} exited with status {1}\n'.format(
+                pid, status))
+            if time.time() - started_at < 1:
+                time.sleep(1)   # do not respawn a crashing worker in a loop
+
+    for pid in workers:
+        os.kill(pid, signal.SIGTERM)
+    deadline = time.time() + graceful_timeout
+    while workers and time.time() < deadline:
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+        if pid:
+            workers.pop(pid, None)
+        else:
+            time.sleep(0.1)
+    for pid in workers:
+        sys.stderr.write('killing worker {}\n'.format(pid))
+        os.kill(pid, signal.SIGKILL)
+
+
+###########
+# Startup #
+###########
+
+parser = argparse.ArgumentParser(
+    description='Serve the Bazaar backend API from a pool of worker '
+    'processes.')
+parser.add_argument('-a', '--addr', metavar='HOST', default='0.0.0.0',
+                    help='Bind to this address.')
+parser.add_argument('-p', '--port', metavar='PORT', type=int, default=8080,
+                    help='Listen on this TCP port.')
+parser.add_argument('-w', '--processes', metavar='N', type=int,
+                    default=os.sysconf('SC_NPROCESSORS_ONLN'),
+                    help='Run this many worker processes (default: one per '
+                    'CPU).')
+parser.add_argument('-t', '--threads', metavar='N', type=int, default=8,
+                    help='Handle this many requests at once in each worker.')
+parser.add_argument('-m', '--max-requests', metavar='N', type=int,
+                    default=10000,
+                    help='Replace each worker after it has handled about '
+                    'this many requests; 0 never replaces them.')
+parser.add_argument('-g', '--graceful-timeout', metavar='SECONDS',
+                    type=float, default=30,
+                    help='On shutdown, wait this long for requests to '
+                    'finish.')
+parser.add_argument('-s', '--static', metavar='DIR',
+                    help='Serve static files from DIR. Better left to the '
+                    'front proxy.')
+
+def main():
+    args = parser.parse_args()
+    application = api.app.router
+    if args.static:
+        application = werkzeug.wsgi.SharedDataMiddleware(
+            application, {'/': args.static})
+    server = Server(args.addr, args.port, application, args.threads,
+                    args.max_requests)
+    # loading the app may have connected; workers make their own pools
+    api.db.close_pools()
+    supervise(server, args.processes, args.graceful_timeout)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import os; os.environ.setdefault('APP_ENV', 'development')
+import sys; sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import json
+import argparse
+
+import api.app
+
+parser = argparse.ArgumentParser(
+    description='Snapshot the columns of the relations backing each model.')
+parser.add_argument('-c', '--check', action='store_true',
+                    help='Compare the current snapshot to the database '
+                    'instead of printing a new one.')
+
+def models(cls=api.app.Model):
+    for subclass in cls.__subclasses__():
+        yield subclass
+        for model in models(subclass):
+            yield model
+
+def main():
+    args = parser.parse_args()
+    relids = set(api.app.SCHEMA)
+    relids.update('{0.db_schema}.{0.db_table}'.format(model)
+                  for model in models()
+                  if hasattr(model, 'db_columns'))
+    with api.app.db.connect():
+        live = {relid: api.app.db.column_names(relid)
+                for relid in relids}
+
+    if not args.check:
+        json.dump(live, sys.stdout, indent=2, sort_keys=True,
+                  separators=(',', ': '))
+        sys.stdout.write('\n')
+        return
+
+    stale = sorted(relid for relid in relids
+                   if api.app.SCHEMA.get(relid) != live[relid])
+    for relid in stale:
+        sys.stderr.write('{0}: snapshot {1}, database {2}\n'.format(
+            relid, api.app.SCHEMA.get(relid), live[relid]))
+    if stale:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -16,7 +16,7 @@ setuptools.setup(
         'pytz',
         'requests==1.2.3',
         'selector==0.9.4',
-        'stripe==1.9.5',
+        'stripe==1.22.0',
         'Werkzeug==0.9.3',
     ],
 )